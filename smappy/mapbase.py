@@ -274,13 +274,15 @@ class ShapeLayer:
 
     def __init__(self, geometry_file: str, line: Optional[LineFormat],
                  fill_color: Optional[Color], fill_opacity: float = 1.0,
-                 selectors: list = [], filter: Callable = None):
+                 selectors: list = [], filter: Callable = None,
+                 marker: Optional[Marker] = None):
         self._geometry_file = geometry_file
         self._line = line
         self._fill_color = fill_color
         self._fill_opacity = fill_opacity
         self._selectors = selectors
         self._filter = filter
+        self._marker = marker
 
     def get_geometry_file(self):
         return self._geometry_file
@@ -300,11 +302,16 @@ class ShapeLayer:
     def get_filter(self):
         return self._filter
 
+    def get_marker(self):
+        'The symbol for point geometries. Points are not drawn without one.'
+        return self._marker
+
 class RasterLayer:
 
-    def __init__(self, rasterfile, stops):
+    def __init__(self, rasterfile, stops, band_cache = None):
         self._rasterfile = rasterfile
         self._stops = stops
+        self._band_cache = band_cache
 
     def get_raster_file(self):
         return self._rasterfile
@@ -312,6 +319,41 @@ class RasterLayer:
     def get_stops(self):
         return self._stops
 
+    def get_band_cache(self):
+        '''Directory where the decoded raster band is kept as a .npy file,
+        which all processes memory-map instead of decoding the raster.'''
+        return self._band_cache
+
+class HeatmapLayer:
+    '''A density map of points, binned into a grid at output resolution.
+    points is an array of (lat, lng) rows, an iterable of such arrays, or
+    the name of a .npy or CSV file with lat and lng columns. Files and
+    arrays are read in chunks, but an iterator can only be rendered once.'''
+
+    def __init__(self, points, stops, smoothing: float = 0,
+                 log_scale: bool = False, opacity: float = 1.0):
+        self._points = points
+        self._stops = stops
+        self._smoothing = smoothing
+        self._log_scale = log_scale
+        self._opacity = opacity
+
+    def get_points(self):
+        return self._points
+
+    def get_stops(self):
+        return self._stops
+
+    def get_smoothing(self):
+        'Standard deviation of the Gaussian smoothing, in pixels.'
+        return self._smoothing
+
+    def get_log_scale(self):
+        return self._log_scale
+
+    def get_opacity(self):
+        return self._opacity
+
 # ===== BASE MAP
 
 class AbstractMap:
@@ -331,15 +373,19 @@ class AbstractMap:
                    fill_color: Optional[str] = None,
                    fill_opacity: float = 1.0,
                    filter: Callable = None,
-                   selectors: Optional[list] = None) -> None:
+                   selectors: Optional[list] = None,
+                   marker: Optional[Marker] = None) -> None:
+        '''marker: symbol to draw Point and MultiPoint geometries with'''
         line = to_line_format(line_color, line_width, line_dash)
         self._layers.append(ShapeLayer(geometry_file, line,
                                        to_color(fill_color),
                                        fill_opacity,
-                                       selectors, filter))
+                                       selectors, filter, marker))
+        if marker:
+            self._symbols.add(marker)
 
-    def add_raster(self, rasterfile, stops):
-        self._layers.append(RasterLayer(rasterfile, stops))
+    def add_raster(self, rasterfile, stops, band_cache = None):
+        self._layers.append(RasterLayer(rasterfile, stops, band_cache))
 
     def add_text_label(self, lat: float, lng: float, text: str, style: TextStyle) -> None:
         self._labels.append((text, lat, lng, style))
@@ -422,6 +468,8 @@ def make_color_scale(count):
 def add_extension(filename, format):
     extension = {
         'png'   : '.png',
+        'webp'  : '.webp',
+        'jpeg'  : '.jpg',
         'html'  : '.html',
         'pdf'   : '.pdf',
         'svg'   : '.svg',
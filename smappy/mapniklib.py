@@ -1,5 +1,6 @@
 
 import json
+from collections.abc import Callable
 from typing import Optional
 from smappy import mapbase
 import pymapnik3
@@ -13,6 +14,25 @@ class MapnikMap(mapbase.AbstractMap):
         self._view = mapview
         self._background = mapbase.to_color(background_color or '#88CCFF')
 
+    def add_shapes(self,
+                   geometry_file: str,
+                   line_color: Optional[str] = None,
+                   line_width: Optional[float] = None,
+                   line_dash: Optional[tuple] = None,
+                   fill_color: Optional[str] = None,
+                   fill_opacity: float = 1.0,
+                   filter: Callable = None,
+                   selectors: Optional[list] = None,
+                   marker: Optional[mapbase.Marker] = None) -> None:
+        '''This backend does not draw point geometries, so a marker is
+        rejected rather than put in the legend with nothing drawn.'''
+        if marker:
+            raise mapbase.SmappyException('The mapnik backend cannot draw '
+                                          'point geometries with a marker')
+        mapbase.AbstractMap.add_shapes(self, geometry_file, line_color,
+                                       line_width, line_dash, fill_color,
+                                       fill_opacity, filter, selectors)
+
     def render_to(self, filename: str, format: str = 'png') -> None:
         filename = mapbase.add_extension(filename, format)
 
@@ -2,15 +2,122 @@
 Backend which draws the map using smappy's own map-rendering implementation.
 '''
 
-import json, math
+import base64, collections, copy, functools, hashlib, io, itertools, json, math, os, struct, tempfile, zlib
 from typing import Optional
+from xml.sax.saxutils import escape, quoteattr
 from smappy import mapbase
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageChops, ImageDraw, ImageFont
 import fpdf
+import numpy
 import shapefile
 
 RESIZE_FACTOR = 4 # to get antialiasing
 
+class Quality:
+    '''Settings which together trade rendering time against output quality.
+
+    supersampling: factor the PNG is drawn larger by, for antialiasing
+    simplification: vertices closer than this (in pixels) are merged
+    raster_step: if set, rasters are sampled at every raster_step pixels
+                 instead of being rendered cell by cell and interpolated
+    halos: whether to draw halos around text'''
+
+    def __init__(self, supersampling: int, simplification: float = 0,
+                 raster_step: Optional[int] = None, halos: bool = True):
+        self._supersampling = supersampling
+        self._simplification = simplification
+        self._raster_step = raster_step
+        self._halos = halos
+
+    def get_supersampling(self):
+        return self._supersampling
+
+    def get_simplification(self):
+        return self._simplification
+
+    def get_raster_step(self):
+        return self._raster_step
+
+    def get_halos(self):
+        return self._halos
+
+QUALITY_PRESETS = {
+    'draft' : Quality(1, simplification = 1.0, raster_step = 2, halos = False),
+    'normal' : Quality(RESIZE_FACTOR),
+    'print' : Quality(6),
+}
+
+class Encoding:
+    '''Options for encoding the output.
+
+    compress_level: zlib level for PNG, from 0 (fastest) to 9 (smallest)
+    colors: if set, PNGs are quantized to an adaptive palette of this many
+            colours
+    quality: for JPEG and lossy WebP, from 1 to 100
+    lossless: for WebP
+    downsample: 'lanczos' or 'box', the filter used to scale the supersampled
+                image down. box is cheaper, but not quite as sharp
+    precision: for SVG, the number of decimals kept in coordinates'''
+
+    def __init__(self, compress_level: int = 6, colors: Optional[int] = None,
+                 quality: int = 85, lossless: bool = False,
+                 downsample: str = 'lanczos', precision: int = 1):
+        if downsample not in DOWNSAMPLE_FILTERS:
+            raise mapbase.SmappyException('Unknown downsample filter: %s'
+                                          % downsample)
+        self._compress_level = compress_level
+        self._colors = colors
+        self._quality = quality
+        self._lossless = lossless
+        self._downsample = downsample
+        self._precision = precision
+
+    def get_compress_level(self):
+        return self._compress_level
+
+    def get_precision(self):
+        return self._precision
+
+    def get_colors(self):
+        return self._colors
+
+    def get_resample_filter(self):
+        return DOWNSAMPLE_FILTERS[self._downsample]
+
+    def can_stream(self, format):
+        'Whether the output can be written a band at a time.'
+        return format == 'png' and not self._colors
+
+    def save(self, image, filename, format):
+        if format == 'png':
+            if self._colors:
+                image = image.quantize(self._colors,
+                                       method = Image.Quantize.FASTOCTREE)
+            image.save(filename, 'PNG', compress_level = self._compress_level)
+        elif format == 'jpeg':
+            image.save(filename, 'JPEG', quality = self._quality)
+        elif format == 'webp':
+            image.save(filename, 'WEBP', quality = self._quality,
+                       lossless = self._lossless)
+        else:
+            assert False, 'Unknown format: %s' % format
+
+DOWNSAMPLE_FILTERS = {
+    'lanczos' : Image.Resampling.LANCZOS,
+    'box' : Image.Resampling.BOX,
+}
+
+BITMAP_FORMATS = ('png', 'webp', 'jpeg')
+
+def get_quality(quality):
+    'quality is a Quality or the name of one of the presets.'
+    if isinstance(quality, Quality):
+        return quality
+    if quality not in QUALITY_PRESETS:
+        raise mapbase.SmappyException('Unknown quality %s, must be one of %s'
+                                      % (quality, ', '.join(QUALITY_PRESETS)))
+    return QUALITY_PRESETS[quality]
+
 class NativeMap(mapbase.AbstractMap):
 
     def __init__(self, mapview: mapbase.MapView,
@@ -18,89 +125,368 @@ class NativeMap(mapbase.AbstractMap):
         mapbase.AbstractMap.__init__(self)
         self._view = mapview
         self._background = mapbase.to_color(background_color or '#88CCFF')
-
-    def render_to(self, filename: str, format: str = 'png') -> None:
+        self._clustering = None
+        self._tile_cache = None
+
+    def set_tile_cache(self, tile_cache):
+        '''Renders raster layers from a TileCache, instead of from the
+        raster files directly.'''
+        self._tile_cache = tile_cache
+
+    def set_clustering(self, clustering = True):
+        '''Draws markers that are close together as a single symbol with a
+        count. clustering is True to cluster the markers of this map, or a
+        ClusterIndex, which can be built once and set on maps of any number
+        of views. The markers in the ClusterIndex are then drawn instead of
+        the map's own.'''
+        self._clustering = clustering
+
+    def add_heatmap(self, points, stops, smoothing: float = 0,
+                    log_scale: bool = False, opacity: float = 1.0) -> None:
+        '''Shows the density of a large number of points. The stops map
+        the number of points per pixel (or its log, with log_scale) to
+        colours, like for rasters. Pixels below the first stop are not
+        drawn.'''
+        self._layers.append(mapbase.HeatmapLayer(points, stops, smoothing,
+                                                 log_scale, opacity))
+
+    def render_to(self, filename: str, format: str = 'png',
+                  band_height: Optional[int] = None,
+                  quality = 'normal',
+                  encoding: Optional[Encoding] = None,
+                  raster_dpi: Optional[float] = None) -> None:
+        '''format: 'png', 'webp', 'jpeg', 'pdf' or 'svg'
+
+        band_height: if set, bitmap output is rendered in horizontal bands
+        of this many pixels, each of which is supersampled and downscaled
+        before the next is drawn. Plain PNGs are streamed to the file band
+        by band, so peak memory is proportional to the band size rather
+        than the map size. Other output is assembled at output resolution.
+
+        quality: 'draft', 'normal', 'print', or a Quality object
+
+        encoding: an Encoding with options for bitmap and SVG output
+
+        raster_dpi: for PDF output, the resolution raster layers are
+        embedded at. The page has a millimetre per map pixel, so 25.4 is
+        one raster pixel per map pixel, which is the default.'''
         format = format or 'png'
         filename = mapbase.add_extension(filename, format)
-        assert format in ('png', 'pdf')
+        assert format in BITMAP_FORMATS + ('pdf', 'svg')
+        quality = get_quality(quality)
+        encoding = encoding or Encoding()
 
         # --- draw the map
         width = self._view.width
         height = self._view.height
-        if format == 'png':
-            drawer = PngDrawer(width, height, self._background)
+        projector = make_projector(self._view, width, height)
+
+        raster_scale = 1
+        if format == 'pdf' and raster_dpi:
+            raster_scale = raster_dpi / MM_PER_INCH
+        layers = [self._prepare_layer(layer, projector, quality, raster_scale)
+                  for layer in self._layers]
+
+        if format in BITMAP_FORMATS and band_height:
+            self._render_bands(filename, format, layers, projector,
+                               band_height, quality, encoding)
+        elif format == 'svg':
+            with open(filename, 'w', encoding = 'utf-8') as outf:
+                drawer = SvgDrawer(outf, width, height, self._background,
+                                   precision = encoding.get_precision(),
+                                   halos = quality.get_halos())
+                placed = self._place_markers(drawer, projector)
+                self._draw(drawer, layers, placed)
+                drawer.close()
         else:
-            drawer = PdfDrawer(width, height, self._background)
+            if format in BITMAP_FORMATS:
+                drawer = PngDrawer(width, height, self._background,
+                                   supersampling = quality.get_supersampling(),
+                                   halos = quality.get_halos(),
+                                   downsample = encoding.get_resample_filter())
+            else:
+                drawer = PdfDrawer(width, height, self._background,
+                                   halos = quality.get_halos())
 
-        projector = make_projector(self._view, width, height)
+            placed = self._place_markers(drawer, projector)
+            self._draw(drawer, layers, placed)
+            if format in BITMAP_FORMATS:
+                encoding.save(drawer.get_image(), filename, format)
+            else:
+                drawer.write_to(filename)
+
+        if self._view.transform:
+            self._view.transform(filename, None)
 
-        for layer in self._layers:
-            if isinstance(layer, mapbase.ShapeLayer):
-                features = extract_features(layer.get_geometry_file(),
-                                            layer.get_selectors(),
-                                            layer.get_filter())
-                for feature in features:
-                    (linestrings, closed) = convert_to_linestrings(feature)
+    def render_atlas(self, filename: str, views, quality = 'normal',
+                     raster_dpi: Optional[float] = None) -> None:
+        '''Renders the map once for each of the views into a single PDF,
+        with one page per view. Fonts are embedded once, identical images
+        are stored once, and geometry files are parsed once for all the
+        pages. raster_dpi is as for render_to.'''
+        views = list(views)
+        if not views:
+            raise ValueError('An atlas needs at least one view')
+
+        filename = mapbase.add_extension(filename, 'pdf')
+        quality = get_quality(quality)
+        raster_scale = raster_dpi / MM_PER_INCH if raster_dpi else 1
+        clustering = self._clustering
+        if clustering is True:
+            clustering = ClusterIndex(self._markers) # can serve all views
+
+        # the geometry is read once here, and only projected for each page
+        sources = [load_shape_layer(layer)
+                   if isinstance(layer, mapbase.ShapeLayer) else None
+                   for layer in self._layers]
+
+        drawer = None
+        for view in views:
+            if drawer:
+                drawer.add_page(view.width, view.height, self._background)
+            else:
+                drawer = PdfDrawer(view.width, view.height, self._background,
+                                   halos = quality.get_halos())
+
+            page = self._for_view(view)
+            page._clustering = clustering
+            projector = make_projector(view, view.width, view.height)
+            layers = [page._prepare_layer(layer, projector, quality,
+                                          raster_scale, source)
+                      for (layer, source) in zip(self._layers, sources)]
+            placed = page._place_markers(drawer, projector)
+            page._draw(drawer, layers, placed)
+
+        if drawer:
+            drawer.write_to(filename)
+
+    def _for_view(self, view):
+        'Returns a shallow copy of the map, showing another view.'
+        themap = copy.copy(self)
+        themap._view = view
+        return themap
+
+    def _prepare_layer(self, layer, projector, quality, raster_scale = 1,
+                       source = None):
+        '''Loads and projects the layer data once, so that it can be drawn
+        any number of times (once per band when rendering in bands).
+        raster_scale: raster pixels per map pixel for raster layers.
+        source: what load_shape_layer returned for a ShapeLayer, if it has
+        been loaded already.'''
+        if isinstance(layer, mapbase.ShapeLayer):
+            (points, features) = source or load_shape_layer(layer)
+            if points is not None:
+                return ProjectedLayer(layer, [], self._project_points(points))
+
+            tolerance = quality.get_simplification()
+            shapes = []
+            points = []
+            for feature in features:
+                if layer.get_marker():
+                    points += convert_to_points(feature)
+                (linestrings, closed) = convert_to_linestrings(feature)
+                if closed:
+                    for rings in convert_to_polygons(feature):
+                        rings = [simplify([projector(coord) for coord in ring],
+                                          tolerance, 3)
+                                 for ring in rings]
+                        if rings[0]:
+                            shapes.append(([ring for ring in rings if ring],
+                                           True))
+                else:
                     for linestring in linestrings:
-                        coords = [projector(coord) for coord in linestring]
+                        coords = simplify([projector(coord)
+                                           for coord in linestring],
+                                          tolerance, 2)
+                        if coords:
+                            shapes.append(([coords], False))
+
+            points = numpy.array(points, dtype = float).reshape((-1, 2))
+            return ProjectedLayer(layer, shapes, self._project_points(points))
+
+        elif isinstance(layer, mapbase.RasterLayer):
+            (view, size) = (self._view, None)
+            if raster_scale != 1:
+                # rendered for a bigger view, then drawn at the map's size
+                size = (view.width, view.height)
+                view = mapbase.MapView(east = view.east, west = view.west,
+                                       south = view.south, north = view.north,
+                                       width = round(view.width * raster_scale),
+                                       height = round(view.height * raster_scale))
+                projector = make_projector(view, view.width, view.height)
+
+            if self._tile_cache:
+                (buffer, mask) = self._tile_cache.render(
+                    view, layer.get_raster_file(), layer.get_stops()
+                )
+            elif quality.get_raster_step():
+                (buffer, mask) = sample_raster(view,
+                                               layer.get_raster_file(),
+                                               layer.get_stops(),
+                                               quality.get_raster_step(),
+                                               layer.get_band_cache())
+            else:
+                (buffer, mask) = render_raster(view, projector,
+                                               layer.get_raster_file(),
+                                               layer.get_stops(),
+                                               layer.get_band_cache())
+            return RasterizedLayer(layer, buffer, mask, size)
 
-                        if closed:
-                            drawer.polygon(coords, layer.get_line_format(),
-                                           layer.get_fill_color(),
-                                           layer.get_fill_opacity())
-                        else:
-                            drawer.line(coords, layer.get_line_format())
+        elif isinstance(layer, mapbase.HeatmapLayer):
+            (buffer, mask) = render_heatmap(self._view, layer)
+            return RasterizedLayer(layer, buffer, mask)
 
-            elif isinstance(layer, mapbase.RasterLayer):
-                render_raster(drawer, self._view, projector,
-                            layer.get_raster_file(),
-                            layer.get_stops())
+        else:
+            assert False, 'Unknown layer type: %s' % layer
 
-            else:
-                assert False, 'Unknown layer type: %s' % layer
+    def _project_points(self, points):
+        'Projects an array of (lng, lat) rows into an array of (x, y) rows.'
+        projector = make_array_projector(self._view, self._view.width,
+                                         self._view.height)
+        (xs, ys) = projector(points[:, 0], points[:, 1])
+        return numpy.column_stack((xs, ys))
+
+    def _place_markers(self, drawer, projector):
+        '''Works out where markers and their titles go. Returns (symbols,
+        texts), where symbols is a list of (point, marker) and texts a list
+        of (point, text, style, bbox).'''
+        positioned = self._position_markers(projector)
 
         bboxer = OverlapIndex()
-        for marker in self._markers: # FIXME: skip if no text placement
-            pt = (marker.get_longitude(), marker.get_latitude())
-            pt = projector(pt)
-            radius = ((marker.get_marker().get_scale() or 10))
+        for (pt, title, mf, radius, count) in positioned: # FIXME: skip if no text placement
             bboxer.add_bbox((pt[0] - radius, pt[1] - radius,
                              pt[0] + radius, pt[1] + radius),
                             'marker')
 
-        for marker in self._markers:
-            mf = marker.get_marker()
+        symbols = []
+        texts = []
+        for (pt, title, mf, radius, count) in positioned:
+            symbols.append((pt, mf, radius))
 
-            pt = (marker.get_longitude(), marker.get_latitude())
-            pt = projector(pt)
-
-            drawer.circle(pt, mf.get_scale() or 10, mf.get_fill_color(),
-                          line_format = mf)
+            if count > 1:
+                style = make_cluster_text_style(mf, radius)
+                bbox = drawer.get_bbox(str(count), style)
+                pos = (pt[0], pt[1] - (bbox[1] + bbox[3]) / 2)
+                texts.append((pos, str(count), style, bbox))
+                continue
 
             if not mf.get_title_display() == mapbase.TitleDisplay.NEXT_TO_SYMBOL:
                 continue
 
-            radius = ((mf.get_scale() or 10) + 2)
-            bbox = drawer.get_bbox(marker.get_title(), mf.get_text_style())
+            radius = radius + 2
+            bbox = drawer.get_bbox(title, mf.get_text_style())
             pos = bboxer.find_text_position(pt,
-                                            marker.get_title(),
+                                            title,
                                             bbox,
                                             radius)
             if pos:
-                drawer.text(pos, marker.get_title(), mf.get_text_style())
+                texts.append((pos, title, mf.get_text_style(), bbox))
 
         #self._draw_overlap_boxes(drawer, bboxer) # for debug
 
         for (text, lat, lng, style) in self._labels:
             pt = projector((lng, lat))
+            texts.append((pt, text, style, drawer.get_bbox(text, style)))
+
+        return (symbols, texts)
+
+    def _position_markers(self, projector):
+        '''Returns the markers to draw as a list of (point, title, marker,
+        radius, count). count is more than 1 for clusters of markers.'''
+        if not self._clustering:
+            return [(projector((marker.get_longitude(), marker.get_latitude())),
+                     marker.get_title(),
+                     marker.get_marker(),
+                     marker.get_marker().get_scale() or 10,
+                     1) for marker in self._markers]
+
+        index = self._clustering
+        if index is True:
+            index = ClusterIndex(self._markers)
+
+        positioned = []
+        for (pt, count, marker) in index.get_clusters(self._view,
+                                                      self._view.width,
+                                                      self._view.height):
+            mf = marker.get_marker()
+            radius = cluster_radius(mf.get_scale() or 10, count)
+            positioned.append((pt, marker.get_title(), mf, radius, count))
+
+        # clusters of the same size are drawn in one go, with one sprite
+        positioned.sort(key = lambda p: p[3])
+        return positioned
+
+    def _draw(self, drawer, layers, placed, band = None):
+        '''band: (index, top, bottom) of the band being drawn, in map
+        pixels, or None to draw everything.'''
+        for layer in layers:
+            layer.draw(drawer, band)
+
+        (symbols, texts) = placed
+        if band:
+            symbols = [(pt, mf, radius) for (pt, mf, radius) in symbols
+                       if in_band(pt[1] - radius, pt[1] + radius, band)]
+
+        # consecutive markers of the same style are drawn in one go
+        for ((mf, radius), run) in itertools.groupby(symbols,
+                                                     key = lambda s: s[1 : ]):
+            drawer.symbols([pt for (pt, _, _) in run], mf, radius)
+
+        for (pt, text, style, bbox) in texts:
+            if band and not in_band(pt[1] + bbox[1], pt[1] + bbox[3], band):
+                continue
             drawer.text(pt, text, style)
 
         if self._legend:
             self._add_legend(drawer)
 
-        drawer.write_to(filename)
-        if self._view.transform:
-            self._view.transform(filename, None)
+    def _render_bands(self, filename, format, layers, projector, band_height,
+                      quality, encoding):
+        width = self._view.width
+        height = self._view.height
+        bands = [(ix, top, min(top + band_height, height))
+                 for (ix, top) in enumerate(range(0, height, band_height))]
+        for layer in layers:
+            layer.bucket(band_height, len(bands))
+
+        if encoding.can_stream(format):
+            with PngStreamWriter(filename, width, height,
+                                 encoding.get_compress_level()) as writer:
+                self._draw_bands(bands, layers, projector, quality, encoding,
+                                 lambda img, top: writer.write_rows(img))
+        else:
+            # the encoder needs the whole image, but at least it's not
+            # supersampled
+            output = Image.new('RGB', (width, height))
+            self._draw_bands(bands, layers, projector, quality, encoding,
+                             lambda img, top: output.paste(img, (0, top)))
+            encoding.save(output, filename, format)
+
+    def _draw_bands(self, bands, layers, projector, quality, encoding,
+                    write_band):
+        'Draws the bands one by one, passing each to write_band(img, top).'
+        width = self._view.width
+        height = self._view.height
+        placed = None
+        for band in bands:
+            (_, top, bottom) = band
+            # the padding keeps the resampling filter from seeing the band
+            # edges, so that the bands join up seamlessly
+            padded_top = max(0, top - BAND_PADDING)
+            padded_bottom = min(height, bottom + BAND_PADDING)
+            drawer = PngDrawer(width, padded_bottom - padded_top,
+                               self._background, origin = (0, padded_top),
+                               supersampling = quality.get_supersampling(),
+                               halos = quality.get_halos(),
+                               downsample = encoding.get_resample_filter())
+
+            if placed is None: # text measurement is the same in every band
+                placed = self._place_markers(drawer, projector)
+            self._draw(drawer, layers, placed, band)
+
+            img = drawer.get_image().crop((0, top - padded_top,
+                                           width, bottom - padded_top))
+            write_band(img, top)
 
     def _draw_overlap_boxes(self, drawer, bboxer):
         lf = mapbase.to_line_format('#000000', 2)
@@ -162,28 +548,11 @@ class NativeMap(mapbase.AbstractMap):
             used_symbols.sort(key = self._legend.get_sorting_key_function())
         for (ix, symbol) in enumerate(used_symbols):
             displacement = displace * ix
-            if symbol.get_shape() == mapbase.Shape.CIRCLE:
-                drawer.circle(
-                    (x1 + offset + r, y1 + offset + displacement + r),
-                    r,
-                    symbol.get_fill_color(),
-                    symbol
-                )
-
-            elif symbol.get_shape() == mapbase.Shape.TRIANGLE:
-                assert False
-                # draw.polygon(
-                #     [
-                #         (x1 + offset + r, y1 + offset + displacement),
-                #         (x1 + offset, y1 + offset + r*2 + displacement),
-                #         (x1 + offset + r*2, y1 + offset + r*2 + displacement)
-                #     ],
-                #     outline = (0, 0, 0),
-                #     fill = symbol.get_fill_color().as_int_tuple(256)
-                # )
-
-            else:
-                assert False, 'Unsupported shape: %s' % symbol.get_shape()
+            drawer.symbols(
+                [(x1 + offset + r, y1 + offset + displacement + r)],
+                symbol,
+                r
+            )
 
             drawer.text(
                 (x1 + 20 * legend_scale + (r * 2), y1 + offset + displacement),
@@ -191,10 +560,102 @@ class NativeMap(mapbase.AbstractMap):
                 style
             )
 
+# --- PREPARED LAYERS
+
+class ProjectedLayer:
+    'A ShapeLayer with its geometry loaded and projected into map pixels.'
+
+    def __init__(self, layer, shapes, points):
+        self._layer = layer
+        # list of (rings, closed). closed shapes are polygons with the
+        # exterior ring first, open shapes have a single linestring
+        self._shapes = shapes
+        # array of (x, y) rows, one for each point geometry
+        self._points = points
+        self._buckets = None
+
+    def get_shapes(self):
+        return self._shapes
+
+    def bucket(self, band_height, band_count):
+        '''Sorts the shapes into the bands they touch, so that drawing a
+        band only has to consider the geometry inside it.'''
+        line_format = self._layer.get_line_format()
+        margin = BAND_PADDING + BAND_SLACK
+        if line_format:
+            margin += line_format.get_line_width()
+
+        self._buckets = [[] for ix in range(band_count)]
+        for (ix, (rings, closed)) in enumerate(self._shapes):
+            if not rings[0]:
+                continue
+            ys = [y for (x, y) in rings[0]]
+            first = max(0, int((min(ys) - margin) // band_height))
+            last = min(band_count - 1, int((max(ys) + margin) // band_height))
+            for bucket in self._buckets[first : last + 1]:
+                bucket.append(ix)
+
+    def draw(self, drawer, band = None):
+        if band:
+            shapes = [self._shapes[ix] for ix in self._buckets[band[0]]]
+        else:
+            shapes = self._shapes
+
+        layer = self._layer
+        polygons = [rings for (rings, closed) in shapes if closed]
+        if polygons:
+            drawer.polygons(polygons, layer.get_line_format(),
+                            layer.get_fill_color(),
+                            layer.get_fill_opacity())
+
+        for (rings, closed) in shapes:
+            if not closed:
+                drawer.line(rings[0], layer.get_line_format())
+
+        marker = layer.get_marker()
+        if marker and len(self._points):
+            radius = marker.get_scale() or 10
+            points = self._points
+            if band:
+                ys = points[:, 1]
+                points = points[(ys + radius >= band[1] - BAND_PADDING) &
+                                (ys - radius <= band[2] + BAND_PADDING)]
+            drawer.symbols(points, marker, radius)
+
+class RasterizedLayer:
+    'A RasterLayer rendered into a bitmap matching the view.'
+
+    def __init__(self, layer, buffer, mask, size = None):
+        '''size: (width, height) of the view, if the bitmap has another
+        resolution than the map'''
+        self._layer = layer
+        self._buffer = buffer
+        self._mask = mask
+        self._size = size
+
+    def bucket(self, band_height, band_count):
+        pass # the drawer crops the bitmap to the band
+
+    def draw(self, drawer, band = None):
+        drawer.bitmap(self._buffer, (0, 0), self._mask, self._size)
+
+BAND_PADDING = 4 # map pixels drawn beyond each band edge, for the resampling
+BAND_SLACK = 32  # extra margin for things which stick out of their bounds
+
+def in_band(ymin, ymax, band):
+    (_, top, bottom) = band
+    margin = BAND_PADDING + BAND_SLACK
+    return ymax >= top - margin and ymin <= bottom + margin
+
 class OverlapIndex:
+    '''Keeps track of the bboxes of what has been placed on the map. The
+    bboxes are indexed in a uniform grid, so that checking for overlaps
+    only has to look at the bboxes in the same grid cells.'''
 
-    def __init__(self):
+    def __init__(self, cell_size = 64):
         self._bboxes = []
+        self._cell_size = cell_size
+        self._grid = {} # (col, row) -> [index into self._bboxes, ...]
 
     def find_text_position(self, pt, text, bbox, radius):
         height = bbox[3] - bbox[1]
@@ -220,19 +681,34 @@ class OverlapIndex:
         # else:
         #     print('Overlaps not:', text)
 
-        self._bboxes.append((pbbox, text))
+        self.add_bbox(pbbox, text)
 
         return pos
 
     def add_bbox(self, bbox, text):
+        ix = len(self._bboxes)
         self._bboxes.append((bbox, text))
+        for cell in self._cells(bbox):
+            self._grid.setdefault(cell, []).append(ix)
 
     def overlaps(self, pbbox):
-        for (bbox, text) in self._bboxes:
+        'Returns the text of the earliest placed bbox overlapping pbbox.'
+        candidates = set()
+        for cell in self._cells(pbbox):
+            candidates.update(self._grid.get(cell, ()))
+
+        for ix in sorted(candidates):
+            (bbox, text) = self._bboxes[ix]
             if overlaps(bbox, pbbox):
                 return text
         return None
 
+    def _cells(self, bbox):
+        size = self._cell_size
+        cols = range(int(bbox[0] // size), int(bbox[2] // size) + 1)
+        rows = range(int(bbox[1] // size), int(bbox[3] // size) + 1)
+        return [(col, row) for col in cols for row in rows]
+
 def overlaps(bbox1, bbox2):
     (ax1, ay1, ax2, ay2) = bbox1
     (bx1, by1, bx2, by2) = bbox2
@@ -244,6 +720,32 @@ def overlaps(bbox1, bbox2):
 # --- PROJECTIONS
 
 def make_projector(view, width, height):
+    (west, north, x_factor, y_factor) = get_projection(view, width, height)
+
+    def meters2pixels(lnglat):
+        # this is GeoJSON, which is lng, lat
+        (lng, lat) = lnglat
+        y = (lat2y(lat) - north) * y_factor
+        x = (west - lon2x(lng)) * x_factor
+        return (x, y)
+
+    return meters2pixels
+
+def make_array_projector(view, width, height):
+    'Like make_projector, but projects numpy arrays of lngs and lats.'
+    (west, north, x_factor, y_factor) = get_projection(view, width, height)
+
+    def meters2pixels(lngs, lats):
+        lats = numpy.radians(lats)
+        ys = (numpy.log(numpy.tan(math.pi / 4 + lats / 2)) * RADIUS - north)
+        xs = (west - numpy.radians(lngs) * RADIUS)
+        return (xs * x_factor, ys * y_factor)
+
+    return meters2pixels
+
+def get_projection(view, width, height):
+    '''Returns (west, north, x_factor, y_factor), where west and north are
+    Mercator meters, and the factors are pixels per meter (negative).'''
     # --- compute map size
     northwest = project((view.west, view.north))
     southeast = project((view.east, view.south))
@@ -262,15 +764,7 @@ def make_projector(view, width, height):
 
     y_factor = height / (south - north)
     x_factor = width / (west - east)
-
-    def meters2pixels(lnglat):
-        # this is GeoJSON, which is lng, lat
-        (lng, lat) = lnglat
-        y = (lat2y(lat) - north) * y_factor
-        x = (west - lon2x(lng)) * x_factor
-        return (x, y)
-
-    return meters2pixels
+    return (west, north, x_factor, y_factor)
 
 RADIUS = 6378137.0 # in meters on the equator
 
@@ -284,8 +778,40 @@ def project(lnglat):
     (lng, lat) = lnglat
     return (lon2x(lng), lat2y(lat))
 
+def simplify(coords, tolerance, min_points):
+    '''Drops the vertices which are in the same tolerance-sized grid cell as
+    the vertex before them, keeping the last vertex. Returns None if fewer
+    than min_points vertices are left.'''
+    if not tolerance or len(coords) <= min_points:
+        return coords if len(coords) >= min_points else None
+
+    cells = numpy.floor(numpy.asarray(coords) / tolerance)
+    keep = numpy.empty(len(coords), dtype = bool)
+    keep[0] = True
+    keep[1 : ] = (cells[1 : ] != cells[ : -1]).any(axis = 1)
+    keep[-1] = True
+    if keep.sum() < min_points:
+        return None
+    return [coords[ix] for ix in numpy.flatnonzero(keep).tolist()]
+
 # --- FORMAT HANDLING
 
+def load_shape_layer(layer):
+    '''Reads the geometry of a ShapeLayer, returning (points, features).
+    points is an array of (lng, lat) rows if the file could be read as
+    just points, and otherwise None, and features is the list of filtered
+    GeoJSON features.'''
+    filename = layer.get_geometry_file()
+    if (layer.get_marker() and filename.endswith('.shp') and
+        not layer.get_selectors() and not layer.get_filter()):
+        # point shapefiles can be read straight into an array
+        points = read_point_shapefile(filename)
+        if points is not None:
+            return (points, None)
+
+    return (None, extract_features(filename, layer.get_selectors(),
+                                   layer.get_filter()))
+
 def extract_features(filename, selectors, filter):
     if filename.endswith('.shp'):
         return extract_features_shp(filename, selectors, filter)
@@ -305,6 +831,28 @@ def extract_features_shp(filename, selectors, filter):
     else:
         return geojson_data['features']
 
+# every record in a shapefile of 2D points is the record header followed
+# by the shape type and the coordinates
+SHP_POINT_RECORD = numpy.dtype([('number', '>i4'), ('length', '>i4'),
+                                ('type', '<i4'), ('x', '<f8'), ('y', '<f8')])
+
+def read_point_shapefile(filename):
+    '''Returns the points in the shapefile as an array of (lng, lat) rows,
+    without going through pyshp, or None if it isn't a shapefile of only
+    2D points.'''
+    with open(filename, 'rb') as inf:
+        header = inf.read(100)
+        (shape_type, ) = struct.unpack('<i', header[32 : 36])
+        if shape_type != 1:
+            return None
+        records = numpy.fromfile(inf, dtype = SHP_POINT_RECORD)
+
+    (file_length, ) = struct.unpack('>i', header[24 : 28]) # in 16-bit words
+    if (file_length * 2 != 100 + records.nbytes or
+        not (records['type'] == 1).all()):
+        return None # has null shapes
+    return numpy.column_stack((records['x'], records['y']))
+
 def extract_features_geojson(filename, selectors, filter):
     return filter_features(selectors, filter, json.load(open(filename))['features'])
 
@@ -362,119 +910,480 @@ def convert_to_linestrings(feature):
     else:
         return [[], False] #assert False
 
+def convert_to_points(feature):
+    'Returns the coordinates of Point and MultiPoint geometries.'
+    if not feature['geometry']:
+        return []
+
+    if feature['geometry']['type'] == 'Point':
+        return [feature['geometry']['coordinates'][ : 2]]
+
+    elif feature['geometry']['type'] == 'MultiPoint':
+        return [coord[ : 2] for coord in feature['geometry']['coordinates']]
+
+    else:
+        return []
+
+def convert_to_polygons(feature):
+    'Returns a list of polygons, each a list of rings with the exterior first.'
+    if feature['geometry']['type'] == 'Polygon':
+        return [feature['geometry']['coordinates']]
+
+    elif feature['geometry']['type'] == 'MultiPolygon':
+        return feature['geometry']['coordinates']
+
+    else:
+        return []
+
 # --- PNG DRAWER
 
 class PngDrawer:
 
-    def __init__(self, width, height, background):
-        self._img = Image.new('RGB', (width * RESIZE_FACTOR,
-                                      height * RESIZE_FACTOR),
+    def __init__(self, width, height, background, origin = (0, 0),
+                 supersampling = RESIZE_FACTOR, halos = True,
+                 downsample = Image.Resampling.LANCZOS):
+        '''origin: map pixel coordinates of the top left corner of the
+        image, for when the drawer only covers a part of the map'''
+        self._origin = origin
+        self._factor = supersampling
+        self._halos = halos
+        self._downsample = downsample
+        self._img = Image.new('RGB', (width * self._factor,
+                                      height * self._factor),
                               background.as_int_tuple(255))
         self._draw = ImageDraw.Draw(self._img, mode = 'RGB')
+        # once a bitmap has been drawn, everything drawn so far is kept
+        # here at output resolution, and _img becomes an overlay
+        self._base = None
 
     def get_size(self):
         return (self._img.width, self._img.height)
 
     def polygon(self, coords, line_format, fill_color, fill_opacity = 1):
-        lw = 0
-        lc = (0, 0, 0)
-        fc = None
-        dashing = ()
-        if line_format:
-            lw = int(line_format.get_line_width()) * RESIZE_FACTOR
-            lc = line_format.get_line_color().as_int_tuple(255)
-            dashing = [length * RESIZE_FACTOR
-                       for length in line_format.get_line_dash()]
-        if fill_color:
-            fc = fill_color.as_int_tuple(255)
+        self.polygons([[coords]], line_format, fill_color, fill_opacity)
+
+    def polygons(self, polygons, line_format, fill_color, fill_opacity = 1):
+        '''Draws all the polygons of a layer. Each polygon is a list of rings,
+        with the exterior first. The fills are rasterized into a single
+        coverage mask, which is then composited once with the fill color.'''
+        polygons = [[self._scale(ring) for ring in rings if ring]
+                    for rings in polygons]
+        polygons = [rings for rings in polygons if rings]
+
+        if fill_color and fill_opacity > 0:
+            self._fill_polygons(polygons, fill_color.as_int_tuple(255),
+                                int(round(fill_opacity * 255)))
+
+        if not line_format:
+            return
+
+        lw = int(line_format.get_line_width()) * self._factor
+        lc = line_format.get_line_color().as_int_tuple(255)
+        dashing = [length * self._factor
+                   for length in line_format.get_line_dash()]
+        for rings in polygons:
+            for coords in rings:
+                if not dashing:
+                    self._draw.polygon(coords, outline = lc, width = lw)
+                else:
+                    draw_dashed_line(self._draw, coords, lc, lw, dashing)
+
+    def _fill_polygons(self, polygons, color, alpha):
+        box = clip_bbox(union_bbox([bbox_of(rings[0]) for rings in polygons]),
+                        self._img.size)
+        if not box:
+            return
+
+        (x0, y0, x1, y1) = box
+        mask = Image.new('L', (x1 - x0, y1 - y0), 0)
+        draw = ImageDraw.Draw(mask)
+        for rings in polygons:
+            rings = [[(x - x0, y - y0) for (x, y) in ring] for ring in rings]
+            if len(rings) == 1:
+                draw.polygon(rings[0], fill = alpha)
+                continue
 
-        coords = [(x * RESIZE_FACTOR, y * RESIZE_FACTOR) for (x, y) in coords]
+            # polygon with holes: fill with even-odd rule by xor-ing rings
+            ringbox = clip_bbox(bbox_of(rings[0]), mask.size)
+            if not ringbox:
+                continue
+            (rx0, ry0, rx1, ry1) = ringbox
+            parity = Image.new('1', (rx1 - rx0, ry1 - ry0), 0)
+            for ring in rings:
+                ringmask = Image.new('1', parity.size, 0)
+                ImageDraw.Draw(ringmask).polygon(
+                    [(x - rx0, y - ry0) for (x, y) in ring], fill = 1
+                )
+                parity = ImageChops.logical_xor(parity, ringmask)
+            mask.paste(alpha, ringbox, parity)
 
-        if not dashing:
-            self._draw.polygon(coords, outline = lc, width = lw, fill = fc)
-        else:
-            draw_dashed_polygon(self._draw, coords, lc, lw, fc, dashing)
+        if self._base:
+            # the overlay is premultiplied, so the colour has to be too
+            color = Image.new('RGBA', mask.size, color)
+            color.putalpha(mask)
+            mask = color = color.convert('RGBa')
+        self._img.paste(color, box, mask)
 
     def line(self, coords, line_format):
         lw = 0
         lc = (0, 0, 0)
+        dashing = ()
         if line_format:
-            lw = int(line_format.get_line_width()) * RESIZE_FACTOR
+            lw = int(line_format.get_line_width()) * self._factor
             lc = line_format.get_line_color().as_int_tuple(255)
+            dashing = [length * self._factor
+                       for length in line_format.get_line_dash()]
 
-        coords = [(x * RESIZE_FACTOR, y * RESIZE_FACTOR) for (x, y) in coords]
-        self._draw.line(coords, fill = lc, width = lw)
+        coords = self._scale(coords)
+        if not dashing:
+            self._draw.line(coords, fill = lc, width = lw)
+        elif len(coords) > 1:
+            draw_dashed_line(self._draw, coords, lc, lw, dashing)
+
+    def symbols(self, points, marker, radius):
+        '''Draws the marker symbol centered on each of the points. The symbol
+        is rasterized once, then stamped onto the image at every point.'''
+        sprite = get_sprite(marker, radius * self._factor, self._factor)
+        corners = (numpy.asarray(points, dtype = float).reshape(-1, 2) -
+                   self._origin) * self._factor
+        corners = numpy.rint(corners).astype(int) - sprite.center
+        (width, height) = sprite.image.size
+        inside = ((corners[:, 0] > -width) & (corners[:, 0] < self._img.width) &
+                  (corners[:, 1] > -height) & (corners[:, 1] < self._img.height))
+
+        if self._factor > 1:
+            # the downscaling does the antialiasing, and pasting through a
+            # bilevel mask is much faster
+            (image, mask) = (sprite.rgb, sprite.bilevel_mask)
+        elif self._base:
+            image = mask = sprite.image.convert('RGBa')
+        else:
+            (image, mask) = (sprite.image, sprite.image)
 
-    def circle(self, point, radius, fill, line_format):
-        'point is center coordinates'
-        point = (point[0] * RESIZE_FACTOR, point[1] * RESIZE_FACTOR)
-        width = line_format.get_line_width()
-        line_color = line_format.get_line_color().as_int_tuple(255)
-        self._draw.circle(point, radius * RESIZE_FACTOR,
-                          fill = fill.as_int_tuple(255),
-                          width = int(width * RESIZE_FACTOR),
-                          outline = line_color)
+        paste = self._img.paste
+        for corner in corners[inside].tolist():
+            paste(image, tuple(corner), mask)
 
     def get_bbox(self, text, style):
         # don't scale by resize factor, because the answer here is given in
         # user-scale coordinates. caller will be computing without scaling
-        font = ImageFont.truetype(style.get_font_name(),
-                                  style.get_font_size(),
-                                  encoding = 'unic')
-        return font.getbbox(text)
+        # the extent is that of the label bitmap, halo included
+        extent = label_cache.get_extent(text,
+                                        drawer_style(style, self._halos),
+                                        self._factor)
+        return tuple([v / self._factor for v in extent])
 
     def text(self, point, text, style):
-        font = ImageFont.truetype(style.get_font_name(),
-                                  style.get_font_size() * RESIZE_FACTOR,
-                                  encoding = 'unic')
+        label = label_cache.get_label(text, drawer_style(style, self._halos),
+                                      self._factor)
+        if not label.image.width or not label.image.height:
+            return
 
+        (x, y) = self._scale_point(point)
         if style.get_text_align() == mapbase.TextAlignment.LEFT:
-            point = (point[0] * RESIZE_FACTOR, point[1] * RESIZE_FACTOR)
+            x += label.extent[0]
         else:
-            offset = get_text_width(font, text) / 2
-            point = (point[0] * RESIZE_FACTOR - offset,
-                     point[1] * RESIZE_FACTOR)
-
-        self._draw.text(point, text,
-                        font = font,
-                        fill = style.get_font_color().as_int_tuple(255),
-                        stroke_width = style.get_halo_radius() * RESIZE_FACTOR,
-                        stroke_fill = style.get_halo_color().as_int_tuple(255))
-
-    def bitmap(self, image, pos, mask):
-        image = Image.fromarray(image)
-        mask = Image.fromarray(mask)
-        image = image.resize((image.size[0] * RESIZE_FACTOR,
-                              image.size[1] * RESIZE_FACTOR),
-                           Image.Resampling.NEAREST)
-        mask = mask.resize((mask.size[0] * RESIZE_FACTOR,
-                            mask.size[1] * RESIZE_FACTOR),
-                           Image.Resampling.NEAREST)
-        self._img.paste(image, (0, 0), mask)
-
-    def write_to(self, filename):
-        if RESIZE_FACTOR != 1:
-            img = self._img.resize((int(self._img.width / RESIZE_FACTOR),
-                                    int(self._img.height / RESIZE_FACTOR)),
-                                   resample = Image.Resampling.LANCZOS)
-        else:
-            img = self._img
-
-        img.save(filename, 'PNG')
-
-def get_text_width(font, text):
-    'Necessary to handle linebreaks in the text'
-    width = 1000000
-    for part in text.split('\n'):
-        (left, top, right, bottom) = font.getbbox(part)
-        width = min(width, right - left)
-    return width
+            x -= label.image.width / 2
+        y += label.extent[1]
+
+        image = label.image
+        if self._base:
+            image = image.convert('RGBa')
+        self._img.paste(image, (int(round(x)), int(round(y))), image)
+
+    def bitmap(self, image, pos, mask, size = None):
+        '''Draws an RGB bitmap at output resolution. What has been drawn so
+        far is downscaled to output resolution and becomes the base the
+        bitmap is pasted onto. Drawing then continues on a supersampled
+        transparent overlay, which get_image composites onto the base.
+        size: (width, height) to scale the bitmap to, in map pixels.'''
+        base = self.get_image()
+        if size and size != (mask.shape[1], mask.shape[0]):
+            image = numpy.asarray(Image.fromarray(image).resize(size))
+            mask = numpy.asarray(Image.fromarray(mask).resize(size))
+
+        # only the rows inside this drawer are needed
+        top = max(0, self._origin[1] - pos[1])
+        bottom = top + base.height
+        y = pos[1] + top - self._origin[1]
+        base.paste(Image.fromarray(image[top : bottom]),
+                   (pos[0] - self._origin[0], y),
+                   Image.fromarray(mask[top : bottom]))
+
+        # the overlay has premultiplied alpha, because pasting an RGBa
+        # image onto it, with itself as the mask, is a proper 'over'
+        self._base = base
+        self._img = Image.new('RGBa', self._img.size, (0, 0, 0, 0))
+        self._draw = ImageDraw.Draw(self._img)
+
+    def get_image(self):
+        'Returns the image downscaled to the final size.'
+        img = self._img
+        if self._factor != 1:
+            img = img.resize((int(img.width / self._factor),
+                              int(img.height / self._factor)),
+                             resample = self._downsample)
+        if not self._base:
+            return img
+
+        # base * (1 - alpha) + overlay, since the overlay is premultiplied
+        (r, g, b, alpha) = img.split()
+        image = self._base.copy()
+        image.paste((0, 0, 0), (0, 0) + image.size, alpha)
+        return ImageChops.add(image, Image.merge('RGB', (r, g, b)))
+
+    def _scale(self, coords):
+        'Translates map pixel coordinates into image pixel coordinates.'
+        (ox, oy) = self._origin
+        return [((x - ox) * self._factor, (y - oy) * self._factor)
+                for (x, y) in coords]
+
+    def _scale_point(self, point):
+        return ((point[0] - self._origin[0]) * self._factor,
+                (point[1] - self._origin[1]) * self._factor)
+
+
+def drawer_style(style, halos):
+    'The style to draw text with, for a drawer that draws halos or not.'
+    if halos or not style.get_halo_radius():
+        return style
+    return without_halo(style)
+
+def without_halo(style):
+    return mapbase.TextStyle(font_name = style.get_font_name(),
+                             font_size = style.get_font_size(),
+                             font_color = style.get_font_color(),
+                             halo_radius = 0,
+                             text_align = style.get_text_align())
+
+def bbox_of(coords):
+    xs = [x for (x, y) in coords]
+    ys = [y for (x, y) in coords]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+def union_bbox(bboxes):
+    return (min([bbox[0] for bbox in bboxes]),
+            min([bbox[1] for bbox in bboxes]),
+            max([bbox[2] for bbox in bboxes]),
+            max([bbox[3] for bbox in bboxes]))
+
+def clip_bbox(bbox, size):
+    '''Turns a float bbox into a pixel box inside an image of the given size,
+    or None if there is no overlap.'''
+    x0 = max(0, int(math.floor(bbox[0])))
+    y0 = max(0, int(math.floor(bbox[1])))
+    x1 = min(size[0], int(math.ceil(bbox[2])) + 1)
+    y1 = min(size[1], int(math.ceil(bbox[3])) + 1)
+    if x0 >= x1 or y0 >= y1:
+        return None
+    return (x0, y0, x1, y1)
+
+@functools.lru_cache(maxsize = 64)
+def load_font(filename, size):
+    '''Opening and parsing a TTF file is expensive, so fonts are cached for
+    all drawers. load_font.cache_info() has the hit and miss counts.'''
+    return ImageFont.truetype(filename, size, encoding = 'unic')
+
+# --- LABEL BITMAPS
+
+class Label:
+    'A text label rendered with its halo into an RGBA image.'
+
+    def __init__(self, image, extent):
+        self.image = image
+        # (left, top, right, bottom) of the image relative to the text
+        # position, as given by ImageDraw.textbbox
+        self.extent = extent
+
+class LabelCache:
+    '''LRU cache of rendered labels, keyed by the text and the text style,
+    and bounded by the total number of pixels in the cached images.'''
+
+    def __init__(self, max_pixels):
+        self._max_pixels = max_pixels
+        self._pixels = 0
+        self._labels = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_label(self, text, style, scale):
+        key = label_key(text, style, scale)
+        label = self._labels.get(key)
+        if label:
+            self.hits += 1
+            self._labels.move_to_end(key)
+            return label
+
+        self.misses += 1
+        label = render_label(text, style, scale)
+        self._labels[key] = label
+        self._pixels += label.image.width * label.image.height
+        while self._pixels > self._max_pixels and len(self._labels) > 1:
+            (_, evicted) = self._labels.popitem(last = False)
+            self._pixels -= evicted.image.width * evicted.image.height
+        return label
+
+    def get_extent(self, text, style, scale):
+        '''Returns the extent the label has, or will have, without rendering
+        it if it isn't already cached.'''
+        label = self._labels.get(label_key(text, style, scale))
+        if label:
+            return label.extent
+        return measure_label(text, style, scale)
+
+def label_key(text, style, scale):
+    halo = style.get_halo_color()
+    return (text, style.get_font_name(), style.get_font_size(),
+            style.get_font_color().as_int_tuple(255),
+            halo.as_int_tuple(255) if halo else None,
+            style.get_halo_radius(), scale)
+
+_measurer = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+
+def measure_label(text, style, scale):
+    'The extent of the label, halo included, as render_label would draw it.'
+    return measure_text(text, style.get_font_name(),
+                        style.get_font_size() * scale,
+                        style.get_halo_radius() * scale)
+
+# labels are measured when placed and again when drawn, and the same texts
+# come up again and again, so every drawer measures each just once
+@functools.lru_cache(maxsize = 4096)
+def measure_text(text, font_name, font_size, stroke_width):
+    font = load_font(font_name, font_size)
+    return _measurer.textbbox((0, 0), text, font = font,
+                              stroke_width = stroke_width)
+
+def render_label(text, style, scale):
+    (left, top, right, bottom) = measure_label(text, style, scale)
+    color = style.get_font_color().as_int_tuple(255)
+    halo = style.get_halo_color()
+    halo = halo.as_int_tuple(255) if halo else color
+
+    # transparent pixels get the halo color, so the antialiased edges of
+    # the halo blend into the right color
+    image = Image.new('RGBA', (right - left, bottom - top), halo + (0, ))
+    ImageDraw.Draw(image).text(
+        (-left, -top), text,
+        font = load_font(style.get_font_name(), style.get_font_size() * scale),
+        fill = color,
+        stroke_width = style.get_halo_radius() * scale,
+        stroke_fill = halo
+    )
+    return Label(image, (left, top, right, bottom))
+
+label_cache = LabelCache(16_000_000)
+
+# --- MARKER SPRITES
+
+SPRITE_OVERSAMPLE = 4 # for antialiasing the sprites themselves
+
+class Sprite:
+    'A marker symbol rasterized into an RGBA image.'
+
+    def __init__(self, image, center):
+        self.image = image
+        self.center = center # pixel of the image where the symbol is centered
+        self.rgb = image.convert('RGB')
+        self.bilevel_mask = image.getchannel('A').point(
+            lambda alpha: 255 if alpha >= 128 else 0
+        ).convert('1')
+
+def get_sprite(marker, radius, scale):
+    'radius is in image pixels, and scale is image pixels per map pixel'
+    return make_sprite(marker.get_shape(), radius,
+                       marker.get_fill_color().as_int_tuple(255),
+                       marker.get_line_color().as_int_tuple(255),
+                       int(marker.get_line_width() * scale))
+
+@functools.lru_cache(maxsize = 256)
+def make_sprite(shape, radius, fill, line_color, line_width):
+    half = int(math.ceil(radius)) + 1
+    size = (half * 2 + 1) * SPRITE_OVERSAMPLE
+    image = Image.new('RGBA', (size, size), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+
+    c = (half + 0.5) * SPRITE_OVERSAMPLE # center of the middle pixel
+    r = radius * SPRITE_OVERSAMPLE
+    width = line_width * SPRITE_OVERSAMPLE
+    if shape == mapbase.Shape.CIRCLE:
+        draw.ellipse((c - r, c - r, c + r, c + r), fill = fill,
+                     outline = line_color, width = width)
+    elif shape == mapbase.Shape.SQUARE:
+        draw.rectangle((c - r, c - r, c + r, c + r), fill = fill,
+                       outline = line_color, width = width)
+    elif shape == mapbase.Shape.TRIANGLE:
+        draw.polygon([(c, c - r), (c - r, c + r), (c + r, c + r)],
+                     fill = fill, outline = line_color, width = width)
+    else:
+        assert False, 'Unsupported shape: %s' % shape
+
+    return Sprite(image.reduce(SPRITE_OVERSAMPLE), (half, half))
+
+class PngStreamWriter:
+    '''Writes an RGB PNG file a band of rows at a time, so that the whole
+    image never has to be in memory. Used as a context manager, which
+    moves the file into place when the block completes, and leaves no
+    file behind if it fails.'''
+
+    def __init__(self, filename, width, height, compress_level = 6):
+        self._filename = filename
+        self._width = width
+        self._height = height
+        self._compress_level = compress_level
+
+    def __enter__(self):
+        self._outf = tempfile.NamedTemporaryFile(
+            dir = os.path.dirname(os.path.abspath(self._filename)),
+            suffix = '.tmp', delete = False
+        )
+        self._outf.write(b'\x89PNG\r\n\x1a\n')
+        self._write_chunk(b'IHDR', struct.pack('>IIBBBBB', self._width,
+                                               self._height, 8, 2, 0, 0, 0))
+        self._compressor = zlib.compressobj(self._compress_level)
+        return self
+
+    def write_rows(self, img):
+        'img is an RGB image of the same width as the PNG'
+        data = img.tobytes()
+        stride = self._width * 3
+        # every row is prefixed with filter type 0 (none)
+        data = b''.join([b'\x00' + data[ix : ix + stride]
+                         for ix in range(0, len(data), stride)])
+        self._write_chunk(b'IDAT', self._compressor.compress(data))
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self._outf.close()
+            os.remove(self._outf.name)
+            return
+
+        self._write_chunk(b'IDAT', self._compressor.flush())
+        self._write_chunk(b'IEND', b'')
+        self._outf.close()
+        os.replace(self._outf.name, self._filename)
+
+    def _write_chunk(self, chunktype, data):
+        if not data and chunktype == b'IDAT':
+            return # compressor is still buffering
+
+        self._outf.write(struct.pack('>I', len(data)))
+        self._outf.write(chunktype)
+        self._outf.write(data)
+        self._outf.write(struct.pack('>I', zlib.crc32(chunktype + data)))
 
 class PdfDrawer:
 
-    def __init__(self, width, height, background):
-        self._size = (width, height)
+    def __init__(self, width, height, background, halos = True):
+        self._halos = halos
         self._pdf = fpdf.FPDF(unit='mm')
+        self._installed_fonts = set()
+        self.add_page(width, height, background)
+
+    def add_page(self, width, height, background):
+        '''Starts a new page, which everything is drawn on from now on.
+        Fonts and images are shared with the earlier pages.'''
+        self._size = (width, height)
         self._pdf.add_page(format = self._size)
 
         (r, g, b) = background.as_int_tuple(255)
@@ -482,13 +1391,12 @@ class PdfDrawer:
         self._pdf.rect(h = self._pdf.h, w = self._pdf.w, x = 0, y = 0,
                        style = 'DF')
 
-        self._installed_fonts = set()
-
     def get_size(self):
         return self._size
 
     def polygon(self, coords, line_format, fill_color, fill_opacity = 1):
         style = self._set_line_and_fill(line_format, fill_color)
+        coords = to_pdf_path(coords)
         if fill_opacity < 1:
             fo = fill_opacity
             with self._pdf.local_context(fill_opacity=fo):
@@ -496,13 +1404,49 @@ class PdfDrawer:
         else:
             self._pdf.polygon(coords, style = style)
 
+    def polygons(self, polygons, line_format, fill_color, fill_opacity = 1):
+        for rings in polygons:
+            rings = [ring for ring in rings if ring]
+            if len(rings) == 1:
+                self.polygon(rings[0], line_format, fill_color, fill_opacity)
+            elif rings:
+                self._polygon_with_holes(rings, line_format, fill_color,
+                                         fill_opacity)
+
+    def _polygon_with_holes(self, rings, line_format, fill_color,
+                            fill_opacity):
+        # one path with a subpath per ring, filled with the even-odd rule,
+        # so the holes are cut out just like in PngDrawer
+        with self._pdf.new_path() as path:
+            style = path.style
+            style.intersection_rule = fpdf.enums.IntersectionRule.EVENODD
+            if fill_color:
+                style.fill_color = to_device_rgb(fill_color)
+                if fill_opacity < 1:
+                    style.fill_opacity = fill_opacity
+            if line_format:
+                style.stroke_color = to_device_rgb(line_format.get_line_color())
+                style.stroke_width = line_format.get_line_width() / 1.5
+            if fill_color and line_format:
+                rule = fpdf.enums.PathPaintRule.STROKE_FILL_EVENODD
+            elif fill_color:
+                rule = fpdf.enums.PathPaintRule.FILL_EVENODD
+            else:
+                rule = fpdf.enums.PathPaintRule.STROKE
+            style.paint_rule = rule
+
+            for ring in rings:
+                ring = to_pdf_path(ring)
+                path.move_to(*ring[0])
+                for point in ring[1 : ]:
+                    path.line_to(*point)
+                path.close()
+
     def line(self, coords, line_format):
         self._set_line_and_fill(line_format, None)
-        for ix in range(len(coords) - 1):
-            self._pdf.line(x1 = coords[ix][0],
-                           y1 = coords[ix][1],
-                           x2 = coords[ix + 1][0],
-                           y2 = coords[ix + 1][1])
+        coords = to_pdf_path(coords)
+        if len(coords) > 1:
+            self._pdf.polyline(coords, style = 'D') # one path, not segments
 
     def _set_line_and_fill(self, line_format, fill_color):
         'Returns drawing style'
@@ -524,27 +1468,62 @@ class PdfDrawer:
         else:
             return 'D'
 
-    def circle(self, point, radius, fill, line_format):
-        style = self._set_line_and_fill(line_format, fill)
-        self._pdf.circle(point[0], point[1], radius, style = style)
+    def symbols(self, points, marker, radius):
+        shape = marker.get_shape()
+        if shape != mapbase.Shape.TRIANGLE and \
+           len(points) >= PDF_MIN_STROKED_SYMBOLS:
+            self._stroked_symbols(points, marker, radius)
+            return
+
+        style = self._set_line_and_fill(marker, marker.get_fill_color())
+        for (x, y) in points:
+            if shape == mapbase.Shape.CIRCLE:
+                self._pdf.circle(x, y, radius, style = style)
+            elif shape == mapbase.Shape.SQUARE:
+                self._pdf.rect(x - radius, y - radius, radius * 2, radius * 2,
+                               style = style)
+            elif shape == mapbase.Shape.TRIANGLE:
+                self._pdf.polygon([(x, y - radius), (x - radius, y + radius),
+                                   (x + radius, y + radius)], style = style)
+            else:
+                assert False, 'Unsupported shape: %s' % shape
+
+    def _stroked_symbols(self, points, marker, radius):
+        # every symbol is a single stroke: a dot with round caps for circles,
+        # and a line as long as it is wide with butt caps for squares. that
+        # is a fraction of the size of the path for each symbol. the outline
+        # is a wider stroke under the fill, drawn right before it, so that
+        # overlapping symbols cover each other as in the other formats
+        line_width = marker.get_line_width() / 1.5
+        passes = [(radius * 2 - line_width, marker.get_fill_color())]
+        if line_width:
+            passes.insert(0, (radius * 2 + line_width, marker.get_line_color()))
+        if marker.get_shape() == mapbase.Shape.CIRCLE:
+            (cap, length) = (fpdf.enums.StrokeCapStyle.ROUND, 0)
+        else:
+            (cap, length) = (fpdf.enums.StrokeCapStyle.BUTT, 1)
+        passes = [(width, to_device_rgb(color), width * length / 2)
+                  for (width, color) in passes if width > 0]
+
+        points = numpy.asarray(points, dtype = float).reshape((-1, 2)).tolist()
+        (pdf, line) = (self._pdf, self._pdf.line)
+        with pdf.local_context(stroke_cap_style = cap):
+            for (x, y) in points:
+                for (width, color, half) in passes:
+                    # only written to the PDF when they change
+                    pdf.set_line_width(width)
+                    pdf.set_draw_color(color)
+                    line(x - half, y, x + half, y)
 
     def get_bbox(self, text, style):
         'returns (left, top, right, bottom)'
-        # we're using a Pillow class here, because it gets the correct
-        # height (and fpdf2 doesn't give height)
-        font = ImageFont.truetype(style.get_font_name(),
-                                  style.get_font_size(),
-                                  encoding = 'unic')
-        (x1, y1, x2, y2) = font.getbbox(text)
-
-        # then using fpdf to get correct width
-        self._set_font(style)
-        width = self._pdf.get_string_width(text)
-        return (0, 0, width, y2 - y1)
+        # the bbox includes the halo, and is measured the same way as in the
+        # other drawers, so that labels are placed the same way in all formats
+        return measure_label(text, drawer_style(style, self._halos), 1)
 
     def text(self, point, text, style):
         self._set_font(style)
-        if style.get_halo_color():
+        if self._halos and style.get_halo_color():
             with self._pdf.local_context(
                     text_mode = 'FILL_STROKE',
                     draw_color = style.get_halo_color().as_int_tuple(255),
@@ -556,23 +1535,33 @@ class PdfDrawer:
     def _text(self, point, text, style, color):
         (r, g, b) = color.as_int_tuple(255)
         self._pdf.set_text_color(r, g, b)
-        # Pillow has the text anchor top left, but fpdf has bottom left
-        (x1, y1, x2, y2) = self.get_bbox(text, style)
-        height = y2 - y1
-        width = x2 - y1
-
+        # Pillow has the text anchor at the top left, but fpdf at the left
+        # end of the baseline
+        font = load_font(style.get_font_name(), style.get_font_size())
+        (ascent, _) = font.getmetrics()
+        (x, y) = point
         if style.get_text_align() == mapbase.TextAlignment.CENTERED:
-            offset = width / 2
-            point = (point[0] - offset, point[1])
-
-        self._pdf.text(point[0], point[1] + height, text)
-
-    def bitmap(self, image, pos, mask):
-        print('WARN: No bitmap support in PDF')
+            (left, _, right, _) = self.get_bbox(text, style)
+            x -= (right - left) / 2 + left # centres the bbox, like PngDrawer
+
+        self._pdf.text(x, y + ascent, text)
+
+    def bitmap(self, image, pos, mask, size = None):
+        '''Embeds the bitmap as one image, with the mask as its soft mask.
+        fpdf2 stores identical images only once, so a raster repeated on
+        several pages costs nothing extra.'''
+        (height, width) = mask.shape
+        (width, height) = size or (width, height)
+        if mask.min() == 255:
+            image = Image.fromarray(image, 'RGB') # no soft mask needed
+        else:
+            image = Image.fromarray(numpy.dstack((image, mask)), 'RGBA')
+        self._pdf.image(image, x = pos[0], y = pos[1], w = width, h = height)
 
     def write_to(self, filename):
         self._pdf.output(filename)
 
+
     def _install_font(self, style):
         font = style.get_font_name()
         if font not in self._installed_fonts:
@@ -584,6 +1573,22 @@ class PdfDrawer:
         self._pdf.set_font(extract_font_name(style.get_font_name()),
                            size = style.get_font_size() * 3)
 
+def to_device_rgb(color):
+    return fpdf.drawing.DeviceRGB(*[v / 255 for v in color.as_int_tuple(255)])
+
+PDF_PRECISION = 0.1 # mm, and the page is one mm per pixel of the view
+MM_PER_INCH = 25.4
+PDF_MIN_STROKED_SYMBOLS = 8 # fewer are not worth changing the line caps
+
+def to_pdf_path(coords):
+    '''Rounds the coordinates to PDF_PRECISION, and drops points which
+    then are the same as the point before them.'''
+    points = numpy.round(numpy.asarray(coords, dtype = float).reshape((-1, 2))
+                         / PDF_PRECISION) * PDF_PRECISION
+    keep = numpy.ones(len(points), dtype = bool)
+    keep[1 : ] = (points[1 : ] != points[ : -1]).any(axis = 1)
+    return points[keep].tolist()
+
 def extract_font_name(filename):
     ix = filename.rfind('/')
     ix2 = filename.rfind('.')
@@ -591,128 +1596,511 @@ def extract_font_name(filename):
         ix2 = len(filename)
     return filename[ix+1 : ix2]
 
-# ===========================================================================
-# EXPERIMENTAL RASTER IMPLEMENTATION
+# --- SVG DRAWER
 
-def render_raster(drawer, view, projector, filename, stops):
-    # step 1: render into buffer matching view dimensions
-    import rasterio, numpy
+class SvgDrawer:
+    '''Writes the map as SVG to outf while it is drawn, without building a
+    document in memory. Coordinates are rounded to precision decimals, and
+    written as whole numbers of 10^-precision pixels (the viewBox does the
+    scaling), with relative path commands. Each marker style is defined
+    once, and then placed with <use>. Consecutive paths with the same
+    style share one <g> with the style attributes.'''
+
+    def __init__(self, outf, width, height, background, precision = 1,
+                 halos = True):
+        self._outf = outf
+        self._size = (width, height)
+        self._unit = 10 ** precision # file units per map pixel
+        self._halos = halos
+        self._group = None # the style of the open <g>, if any
+        self._symbols = {} # (marker, radius) -> id of definition
+
+        outf.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        outf.write('<svg xmlns="http://www.w3.org/2000/svg" '
+                   'xmlns:xlink="http://www.w3.org/1999/xlink" '
+                   'width="%s" height="%s" viewBox="0 0 %s %s">\n' % (
+                       width, height, width * self._unit, height * self._unit
+                   ))
+        outf.write('<rect width="100%%" height="100%%" fill="%s"/>\n'
+                   % background.as_hex())
 
-    minimum_value = stops[0][0]
+    def get_size(self):
+        return self._size
+
+    def polygon(self, coords, line_format, fill_color, fill_opacity = 1):
+        self.polygons([[coords]], line_format, fill_color, fill_opacity)
+
+    def polygons(self, polygons, line_format, fill_color, fill_opacity = 1):
+        self._set_group(self._paint(line_format, fill_color, fill_opacity))
+        for rings in polygons:
+            path = ''.join([self._path(ring, 'z') for ring in rings])
+            if path:
+                self._outf.write('<path d="%s"/>\n' % path)
+
+    def line(self, coords, line_format):
+        self._set_group(self._paint(line_format, None))
+        path = self._path(coords)
+        if path:
+            self._outf.write('<path d="%s"/>\n' % path)
+
+    def symbols(self, points, marker, radius):
+        key = (marker, radius)
+        symbol = self._symbols.get(key)
+        if not symbol:
+            symbol = 'm%s' % len(self._symbols)
+            self._symbols[key] = symbol
+            self._set_group(None)
+            self._outf.write('<defs>%s</defs>\n'
+                             % self._shape(symbol, marker, radius))
+
+        self._set_group(None)
+        points = numpy.asarray(points, dtype = float).reshape((-1, 2))
+        points = numpy.rint(points * self._unit).astype(numpy.int64)
+        self._outf.write(''.join([
+            '<use xlink:href="#%s" x="%s" y="%s"/>\n' % (symbol, x, y)
+            for (x, y) in points.tolist()
+        ]))
+
+    def _shape(self, symbol, marker, radius):
+        r = self._number(radius)
+        attrs = ((('id', symbol), ) +
+                 self._paint(marker, marker.get_fill_color()))
+        shape = marker.get_shape()
+        if shape == mapbase.Shape.CIRCLE:
+            return '<circle r="%s"%s/>' % (r, format_attributes(attrs))
+        elif shape == mapbase.Shape.SQUARE:
+            return '<rect x="-%s" y="-%s" width="%s" height="%s"%s/>' % (
+                r, r, self._number(radius * 2), self._number(radius * 2),
+                format_attributes(attrs)
+            )
+        elif shape == mapbase.Shape.TRIANGLE:
+            return '<polygon points="0,-%s -%s,%s %s,%s"%s/>' % (
+                r, r, r, r, r, format_attributes(attrs)
+            )
+        else:
+            assert False, 'Unsupported shape: %s' % shape
 
-    dataset = rasterio.open(filename)
-    band1 = dataset.read(1)
+    def get_bbox(self, text, style):
+        'returns (left, top, right, bottom)'
+        return measure_label(text, drawer_style(style, self._halos), 1)
 
-    (lng, lat) = (view.west, view.north)
-    lat = find_correct_north(lng, lat, projector)
+    def text(self, point, text, style):
+        style = drawer_style(style, self._halos)
+        font = load_font(style.get_font_name(), style.get_font_size())
+        (ascent, _) = font.getmetrics() # the point is at the top of the text
+        attrs = [('x', self._number(point[0])),
+                 ('y', self._number(point[1] + ascent)),
+                 ('font-family', extract_font_name(style.get_font_name())),
+                 ('font-size', self._number(style.get_font_size())),
+                 ('fill', style.get_font_color().as_hex())]
+        if style.get_halo_radius() and style.get_halo_color():
+            attrs += [('stroke', style.get_halo_color().as_hex()),
+                      ('stroke-width',
+                       self._number(style.get_halo_radius() * 2)),
+                      ('stroke-linejoin', 'round'),
+                      ('paint-order', 'stroke')]
+        if style.get_text_align() == mapbase.TextAlignment.CENTERED:
+            attrs.append(('text-anchor', 'middle'))
+
+        self._set_group(None)
+        self._outf.write('<text%s>%s</text>\n' % (format_attributes(attrs),
+                                                  escape(text)))
+
+    def bitmap(self, image, pos, mask, size = None):
+        'Embeds the bitmap as a PNG, with the mask as its alpha channel.'
+        (height, width) = mask.shape
+        (width, height) = size or (width, height)
+        png = io.BytesIO()
+        Image.fromarray(numpy.dstack((image, mask)), 'RGBA').save(png, 'PNG')
+
+        self._set_group(None)
+        self._outf.write(
+            '<image x="%s" y="%s" width="%s" height="%s" '
+            'preserveAspectRatio="none" xlink:href="data:image/png;base64,'
+            % (self._number(pos[0]), self._number(pos[1]),
+               self._number(width), self._number(height))
+        )
+        self._outf.write(base64.b64encode(png.getvalue()).decode('ascii'))
+        self._outf.write('"/>\n')
+
+    def close(self):
+        'Writes the end of the document. Does not close outf.'
+        self._set_group(None)
+        self._outf.write('</svg>\n')
+
+
+    def _path(self, coords, end = ''):
+        '''Path data for the coordinates, as a move and then relative lines.
+        Points which are the same as the one before after rounding are
+        dropped.'''
+        points = numpy.asarray(coords, dtype = float).reshape((-1, 2))
+        points = numpy.rint(points * self._unit).astype(numpy.int64)
+        deltas = numpy.diff(points, axis = 0)
+        deltas = deltas[deltas.any(axis = 1)]
+        if not len(deltas):
+            return ''
+        return 'M%s %sl%s%s' % (points[0, 0], points[0, 1],
+                                ' '.join(map(str, deltas.ravel().tolist())),
+                                end)
+
+    def _paint(self, line_format, fill_color, fill_opacity = 1):
+        'Returns the style attributes for the fill and line, as a tuple.'
+        attrs = [('fill', fill_color.as_hex() if fill_color else 'none')]
+        if fill_color and fill_opacity < 1:
+            attrs.append(('fill-opacity', '%.3g' % fill_opacity))
+        if fill_color:
+            attrs.append(('fill-rule', 'evenodd')) # holes are holes
+
+        if line_format and line_format.get_line_width():
+            attrs += [('stroke', line_format.get_line_color().as_hex()),
+                      ('stroke-width',
+                       self._number(line_format.get_line_width())),
+                      ('stroke-linejoin', 'round')]
+            if isinstance(line_format, mapbase.LineFormat) and \
+               line_format.get_line_dash(): # markers have no dashes
+                attrs.append(('stroke-dasharray', ' '.join([
+                    self._number(length)
+                    for length in line_format.get_line_dash()
+                ])))
+        return tuple(attrs)
+
+    def _number(self, value):
+        'The value in map pixels, in file units.'
+        return str(int(round(value * self._unit)))
+
+    def _set_group(self, attrs):
+        'Makes sure the open <g> has these style attributes, or closes it.'
+        if attrs == self._group:
+            return
+        if self._group is not None:
+            self._outf.write('</g>\n')
+        self._group = attrs
+        if attrs is not None:
+            self._outf.write('<g%s>\n' % format_attributes(attrs))
+
+def format_attributes(attrs):
+    return ''.join([' %s=%s' % (name, quoteattr(str(value)))
+                    for (name, value) in attrs])
 
-    (row, col) = dataset.index(lng, lat)
-    startcol = col
+# ===========================================================================
+# EXPERIMENTAL RASTER IMPLEMENTATION
 
+def render_raster(view, projector, filename, stops, band_cache = None):
+    'Returns (buffer, mask) with the raster rendered to match the view.'
+    # step 1: render into buffer matching view dimensions
     buffer = numpy.zeros((view.height, view.width, 3),
                          dtype = numpy.uint8) # 3-tuples of (RGB)
     mask = numpy.zeros((view.height, view.width),
                          dtype = numpy.uint8) # 1-tuples of (A)
-    while lat > view.south:
-        (lng_, _) = dataset.xy(row, col + 5)
-        lng_delta = (lng_ - lng) / 5
-        (x, y) = projector((lng, lat))
-        (x_, _) = projector((lng_, lat))
-        vx = (x_ - x) / 5
-
-        while lng < view.east:
-            value = band1[row, col]
-            if value >= minimum_value:
-                try:
-                    buffer[int(y)][int(x)] = value_to_color(value, stops)
-                    mask[int(y)][int(x)] = 255
-                except IndexError:
-                    pass # we don't care
-            else:
-                try:
-                    mask[int(y)][int(x)] = 1 # means: pixel with no value
-                except IndexError:
-                    pass # we don't care
-
-            col += 1
-            lng += lng_delta
-            x += vx
 
-        row += 1
-        col = startcol
-        (lng, lat) = dataset.xy(row, col)
+    north = find_correct_north(view.west, view.north, projector)
+    (band1, transform) = read_raster(filename, band_cache, view.west, north,
+                                     view.east, view.south,
+                                     view.width, view.height)
+
+    # Mercator is separable, so the pixel row only depends on the raster
+    # row, and the pixel column only on the raster column
+    rows = numpy.arange(band1.shape[0])
+    lats = transform.f + (rows + 0.5) * transform.e
+    rows = rows[lats > view.south]
+    cols = numpy.arange(band1.shape[1])
+    lngs = transform.c + (cols + 0.5) * transform.a
+    cols = cols[lngs < view.east]
+
+    array_projector = make_array_projector(view, view.width, view.height)
+    (xs, _) = array_projector(lngs[ : len(cols)], 0)
+    (_, ys) = array_projector(0, lats[ : len(rows)])
+    xs = xs.astype(int)
+    ys = ys.astype(int)
+    col_ok = (xs >= 0) & (xs < view.width)
+    row_ok = (ys >= 0) & (ys < view.height)
+
+    values = band1[rows[row_ok, None], cols[None, col_ok]]
+    (colors, _) = colorize(values, stops)
+
+    # where several raster cells land on the same pixel the last one wins
+    target = (ys[row_ok, None], xs[None, col_ok])
+    has_value = values >= stops[0][0]
+    colors[~has_value] = 0
+    buffer[target] = colors
+    mask[target] = numpy.where(has_value, 255, 1) # 1 means: pixel with no value
 
     # step 2: interpolate missing data
     interpolate(buffer, mask)
-
-    # step 3: paste into drawer
-    drawer.bitmap(buffer, (0, 0), mask)
+    return (buffer, mask)
+
+def sample_raster(view, filename, stops, step, band_cache = None):
+    '''Returns (buffer, mask) like render_raster, but only looks up the
+    raster cell under every step-th pixel, and does no interpolation.
+    Much faster, and good enough for drafts.'''
+    (width, height) = (view.width, view.height)
+    (west, north, x_factor, y_factor) = get_projection(view, width, height)
+    xs = numpy.arange(0, width, step) + step / 2
+    ys = numpy.arange(0, height, step) + step / 2
+    lngs = numpy.degrees((west - xs / x_factor) / RADIUS)
+    lats = numpy.degrees(2 * numpy.arctan(numpy.exp((ys / y_factor + north)
+                                                    / RADIUS)) - math.pi / 2)
+
+    (band, transform) = read_raster(filename, band_cache, lngs[0], lats[0],
+                                    lngs[-1], lats[-1], len(lngs), len(lats))
+
+    cols = numpy.floor((lngs - transform.c) / transform.a).astype(int)
+    rows = numpy.floor((lats - transform.f) / transform.e).astype(int)
+    col_ok = (cols >= 0) & (cols < band.shape[1])
+    row_ok = (rows >= 0) & (rows < band.shape[0])
+    if not col_ok.any() or not row_ok.any():
+        return (numpy.zeros((height, width, 3), dtype = numpy.uint8),
+                numpy.zeros((height, width), dtype = numpy.uint8))
+
+    cols = numpy.clip(cols, 0, band.shape[1] - 1)
+    rows = numpy.clip(rows, 0, band.shape[0] - 1)
+    values = band[rows[:, None], cols[None, :]]
+    (buffer, mask) = colorize(values, stops)
+    mask[~row_ok, :] = 0
+    mask[:, ~col_ok] = 0
+
+    buffer = buffer.repeat(step, axis = 0).repeat(step, axis = 1)
+    mask = mask.repeat(step, axis = 0).repeat(step, axis = 1)
+    return (buffer[ : height, : width], mask[ : height, : width])
+
+def read_raster(filename, band_cache, west, north, east, south, width, height):
+    '''Like read_window, but with the raster file name. If band_cache is
+    set the band is read from a memory-mapped copy in that directory.'''
+    import rasterio
+
+    with rasterio.open(filename) as dataset:
+        if band_cache:
+            dataset = MappedBand(dataset, map_band(dataset, band_cache))
+        return read_window(dataset, west, north, east, south, width, height)
+
+def read_window(dataset, west, north, east, south, width, height):
+    '''Reads the part of the first band which covers the bounds, decimated
+    to no fewer than width x height cells. GDAL uses the overviews in the
+    file for decimated reads, if there are any. Returns (band, transform),
+    where transform is the geotransform of the band that was read.'''
+    from rasterio.transform import Affine
+    from rasterio.windows import Window
+
+    (row0, col0) = dataset.index(west, north)
+    (row1, col1) = dataset.index(east, south)
+    (row0, col0) = (max(0, row0), max(0, col0))
+    (row1, col1) = (min(dataset.height, row1 + 1), min(dataset.width, col1 + 1))
+    if row0 >= row1 or col0 >= col1:
+        return (numpy.zeros((0, 0), dtype = dataset.dtypes[0]),
+                dataset.transform)
+
+    # whole cells per value keeps the geotransform of the result exact
+    factor = max(1, min((col1 - col0) // width, (row1 - row0) // height))
+    col1 = min(dataset.width, col0 + -(-(col1 - col0) // factor) * factor)
+    row1 = min(dataset.height, row0 + -(-(row1 - row0) // factor) * factor)
+    out_shape = (int(math.ceil((row1 - row0) / factor)),
+                 int(math.ceil((col1 - col0) / factor)))
+    window = Window(col0, row0, col1 - col0, row1 - row0)
+    band = dataset.read(1, window = window, out_shape = out_shape)
+
+    # assumes a north-up raster
+    transform = dataset.window_transform(window) * Affine.scale(
+        (col1 - col0) / out_shape[1], (row1 - row0) / out_shape[0])
+    return (band, transform)
+
+# --- MEMORY-MAPPED BANDS
+
+BAND_CACHE_ROWS = 1024 # rows decoded at a time when the cache file is made
+
+class MappedBand:
+    '''Wraps a rasterio dataset so that read_window reads the first band
+    from a memory-mapped array instead of decoding it from the file. The
+    pages of the array are shared between all processes mapping it.'''
+
+    def __init__(self, dataset, band):
+        self._dataset = dataset
+        self._band = band
+
+    def __getattr__(self, name):
+        return getattr(self._dataset, name)
+
+    def read(self, index, window, out_shape):
+        assert index == 1, 'Only the first band is mapped'
+        rows = cell_indexes(window.row_off, window.height, out_shape[0])
+        cols = cell_indexes(window.col_off, window.width, out_shape[1])
+        if len(rows) == window.height and len(cols) == window.width:
+            return numpy.array(self._band[rows[0] : rows[-1] + 1,
+                                          cols[0] : cols[-1] + 1])
+        return self._band[rows[:, None], cols[None, :]]
+
+def cell_indexes(offset, length, count):
+    'Index of the cell nearest the centre of each of count blocks.'
+    return offset + ((numpy.arange(count) + 0.5) * length / count).astype(int)
+
+def map_band(dataset, directory):
+    '''Returns the first band of the dataset as a read-only memory map,
+    decoding it into a .npy file in the directory first if necessary.'''
+    filename = os.path.abspath(dataset.name)
+    key = repr((filename, os.path.getmtime(filename)))
+    path = os.path.join(directory, '%s-%s.npy' % (
+        os.path.splitext(os.path.basename(filename))[0],
+        hashlib.sha1(key.encode('utf-8')).hexdigest()[ : 16]
+    ))
+
+    if not os.path.exists(path):
+        from rasterio.windows import Window
+
+        os.makedirs(directory, exist_ok = True)
+        with tempfile.NamedTemporaryFile(dir = directory, suffix = '.tmp',
+                                         delete = False) as outf:
+            tmpfile = outf.name
+        band = numpy.lib.format.open_memmap(
+            tmpfile, mode = 'w+', dtype = dataset.dtypes[0],
+            shape = (dataset.height, dataset.width)
+        )
+        for row in range(0, dataset.height, BAND_CACHE_ROWS):
+            rows = min(BAND_CACHE_ROWS, dataset.height - row)
+            band[row : row + rows] = dataset.read(
+                1, window = Window(0, row, dataset.width, rows)
+            )
+        band.flush()
+        del band
+        os.replace(tmpfile, path) # nobody else ever sees a partial file
+
+    return numpy.load(path, mmap_mode = 'r')
+
+# --- RASTER TILE CACHE
+
+TILE_SIZE = 256     # pixels
+TILE_MARGIN = 32    # pixels rendered around each tile, so that the
+                    # interpolation also fills the gaps at the tile edges
+
+class TileCache:
+    '''A disk cache of colourized raster tiles in Web Mercator, for zoom
+    levels up to the resolution of the raster. Tiles are rendered the first
+    time they are needed, and are kept per raster file, modification time
+    and stops, so tiles for an older version of the raster are not used.'''
+
+    def __init__(self, directory, max_zoom = None):
+        '''max_zoom: by default the first zoom level where the tile pixels
+        are smaller than the raster cells'''
+        self._directory = directory
+        self._max_zoom = max_zoom
+
+    def render(self, view, filename, stops):
+        'Returns (buffer, mask) like render_raster.'
+        (west, north, x_factor, y_factor) = get_projection(view, view.width,
+                                                           view.height)
+        world = 2 * math.pi * RADIUS # in meters
+        zoom = int(math.ceil(math.log2(abs(x_factor) * world / TILE_SIZE)))
+        zoom = min(max(zoom, 0), self._get_max_zoom(filename))
+        size = TILE_SIZE * 2 ** zoom # pixels across the world at this zoom
+
+        # the view, in pixels of the zoom level
+        left = (west + world / 2) / world * size
+        top = (world / 2 - north) / world * size
+        right = left + view.width / abs(x_factor) / world * size
+        bottom = top + view.height / abs(y_factor) / world * size
+
+        last = 2 ** zoom - 1
+        (tx0, ty0) = (max(0, int(left // TILE_SIZE)),
+                      max(0, int(top // TILE_SIZE)))
+        (tx1, ty1) = (min(last, int(right // TILE_SIZE)),
+                      min(last, int(bottom // TILE_SIZE)))
+
+        directory = os.path.join(self._directory,
+                                 tile_set_key(filename, stops), str(zoom))
+        mosaic = Image.new('RGBA', ((tx1 - tx0 + 1) * TILE_SIZE,
+                                    (ty1 - ty0 + 1) * TILE_SIZE))
+        for tx in range(tx0, tx1 + 1):
+            for ty in range(ty0, ty1 + 1):
+                tile = get_tile(directory, filename, stops, zoom, tx, ty)
+                mosaic.paste(tile, ((tx - tx0) * TILE_SIZE,
+                                    (ty - ty0) * TILE_SIZE))
+
+        (x0, y0) = (tx0 * TILE_SIZE, ty0 * TILE_SIZE)
+        box = (max(0, left - x0), max(0, top - y0),
+               min(mosaic.width, right - x0), min(mosaic.height, bottom - y0))
+        image = numpy.asarray(mosaic.resize((view.width, view.height),
+                                            Image.Resampling.BILINEAR,
+                                            box = box))
+        return (image[..., : 3].copy(), image[..., 3].copy())
+
+    def _get_max_zoom(self, filename):
+        if self._max_zoom is not None:
+            return self._max_zoom
+
+        import rasterio
+        with rasterio.open(filename) as dataset:
+            cells = 360 / abs(dataset.transform.a) # across the world
+        return max(0, int(math.ceil(math.log2(cells / TILE_SIZE))))
+
+def tile_set_key(filename, stops):
+    stops = tuple((stop, tuple(color)) for (stop, color) in stops)
+    key = repr((os.path.abspath(filename), os.path.getmtime(filename), stops,
+                TILE_SIZE))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[ : 16]
+
+def get_tile(directory, filename, stops, zoom, tx, ty):
+    'Loads the tile from the cache, rendering it first if necessary.'
+    path = os.path.join(directory, '%s_%s.png' % (tx, ty))
+    if os.path.exists(path):
+        with Image.open(path) as tile:
+            return tile.convert('RGBA')
+
+    tile = render_tile(filename, stops, zoom, tx, ty)
+    os.makedirs(directory, exist_ok = True)
+    with tempfile.NamedTemporaryFile(dir = directory, suffix = '.tmp',
+                                     delete = False) as outf:
+        tile.save(outf, 'PNG')
+    os.replace(outf.name, path) # so that nobody reads a half-written tile
+    return tile
+
+def render_tile(filename, stops, zoom, tx, ty):
+    margin = TILE_MARGIN / TILE_SIZE
+    (west, north) = world_to_lnglat((tx - margin) / 2 ** zoom,
+                                    (ty - margin) / 2 ** zoom)
+    (east, south) = world_to_lnglat((tx + 1 + margin) / 2 ** zoom,
+                                    (ty + 1 + margin) / 2 ** zoom)
+    size = TILE_SIZE + TILE_MARGIN * 2
+    view = mapbase.MapView(east = float(east), west = float(west),
+                           south = float(south), north = float(north),
+                           width = size, height = size)
+    (buffer, mask) = render_raster(view, make_projector(view, size, size),
+                                   filename, stops)
+    tile = Image.fromarray(numpy.dstack((buffer, mask)), 'RGBA')
+    return tile.crop((TILE_MARGIN, TILE_MARGIN,
+                      TILE_MARGIN + TILE_SIZE, TILE_MARGIN + TILE_SIZE))
 
 def interpolate(buffer, mask):
-    for y in range(buffer.shape[0]):
-        prev_x = None
-        prev_m = None
-        for x in range(buffer.shape[1]):
-            if mask[y][x] == 255:
-                if prev_m == 255 and prev_x + 1 < x:
-                    colordelta = diff(buffer[y][prev_x], buffer[y][x],
-                                      x - prev_x)
-                    color = buffer[y][prev_x]
-                    while prev_x+1 < x:
-                        prev_x += 1
-                        color = add_color(color, colordelta)
-                        buffer[y][prev_x] = color
-                        mask[y][prev_x] = 255
-
-                prev_x = x
-                prev_m = 255
-            elif mask[y][x] == 1:
-                if prev_m == 1:
-                    for xx in range(prev_x + 1, x):
-                        mask[y][xx] = 1 # interpolate 'no data'
-                prev_x = x
-                prev_m = 1
-
-    for x in range(buffer.shape[1]):
-        prev_y = None
-        for y in range(buffer.shape[0]):
-            if mask[y][x] == 255:
-                if prev_y is not None and prev_y + 1 < y:
-                    colordelta = diff(buffer[prev_y][x], buffer[y][x],
-                                      y - prev_y)
-                    color = buffer[prev_y][x]
-                    while prev_y+1 < y:
-                        prev_y += 1
-                        color = add_color(color, colordelta)
-                        buffer[prev_y][x] = color
-                        mask[prev_y][x] = 255
-
-                prev_y = y
-            elif mask[y][x] == 1:
-                prev_y = None
-
-def diff(c1, c2, dist):
-    return ((int(c2[0]) - int(c1[0])) / dist,
-            (int(c2[1]) - int(c1[1])) / dist,
-            (int(c2[2]) - int(c1[2])) / dist)
-
-def add_color(color, delta):
-    return (color[0] + delta[0],
-            color[1] + delta[1],
-            color[2] + delta[2])
-
-def value_to_color(value, stops):
-    for (ix, (stop, color)) in enumerate(stops):
-        if value <= stop:
-            dist = (value - stops[ix-1][0]) / (stop - stops[ix-1][0])
-            return intermediate_color(stops[ix-1][1], color, dist)
-    return color # max out to last colour
-
-def intermediate_color(c1, c2, percent):
-    # percent 0.0 => c1
-    # percent 1.0 => c2
-    delta = [d * (1000 * percent) for d in diff(c1, c2, 1000)]
-    return add_color(c1, delta)
+    '''Fills the gaps between the pixels the raster was rendered into,
+    first along the rows, then along the columns. A gap between two pixels
+    with values gets linearly interpolated colours. In the row pass, a gap
+    between two pixels with no value also gets no value.'''
+    fill_gaps(buffer, mask, True)
+    fill_gaps(buffer.transpose((1, 0, 2)), mask.T, False)
+
+def fill_gaps(buffer, mask, fill_no_data):
+    'Fills the gaps along the rows of the arrays, which may be views.'
+    width = mask.shape[1]
+    ixs = numpy.arange(width)
+    marked = mask != 0
+
+    # for every pixel, the index of the nearest marked pixel on each side
+    prev_ix = numpy.maximum.accumulate(numpy.where(marked, ixs, -1), axis = 1)
+    next_ix = numpy.minimum.accumulate(
+        numpy.where(marked, ixs, width)[:, ::-1], axis = 1
+    )[:, ::-1]
+
+    (ys, xs) = numpy.nonzero(~marked & (prev_ix >= 0) & (next_ix < width))
+    (x0, x1) = (prev_ix[ys, xs], next_ix[ys, xs])
+    (m0, m1) = (mask[ys, x0], mask[ys, x1])
+
+    colored = (m0 == 255) & (m1 == 255)
+    (ys_, xs_, x0, x1) = (ys[colored], xs[colored], x0[colored], x1[colored])
+    start = buffer[ys_, x0].astype(float)
+    delta = (buffer[ys_, x1] - start) / (x1 - x0)[:, None]
+    buffer[ys_, xs_] = start + delta * (xs_ - x0)[:, None]
+    mask[ys_, xs_] = 255
+
+    if fill_no_data:
+        no_data = (m0 == 1) & (m1 == 1)
+        mask[ys[no_data], xs[no_data]] = 1
 
 def find_correct_north(lng, lat, projector):
     pos = projector((lng, lat))
@@ -722,56 +2110,305 @@ def find_correct_north(lng, lat, projector):
     return lat
 
 # ===========================================================================
-# DASHED LINE IMPLEMENTATION
-
-class Dasher:
-
-    def __init__(self, dash_pattern: tuple[int]):
-        self._dash_pattern = dash_pattern
-        self._pixels_used = 0 # how many pixels of current step used?
-        self._steps = 0       # how many steps through pattern?
-
-    def make_next_step(self, max_length: float) -> float:
-        current = self._steps % len(self._dash_pattern)
-        step = min(
-            self._dash_pattern[current] - self._pixels_used,
-            max_length
-        )
-
-        self._pixels_used += step
-        if self._pixels_used >= self._dash_pattern[current]:
-            self._pixels_used = 0
-            self._steps += 1
-
-        return step
-
-    def is_current_dash(self):
-        return self._steps % 2 == 0
-
-def dist(p1, p2):
-    return math.sqrt((p1[0] - p2[0]) ** 2 + (p1[1] - p2[1]) ** 2)
-
-def draw_dashed_polygon(draw, coords, lc, lw, fc, dashing):
-    if fc:
-        draw.polygon(coords, outline = None, width = 0, fill = fc)
-
-    dasher = Dasher(dashing)
+# HEATMAPS
+
+HEATMAP_CHUNK_SIZE = 1_000_000 # points
+
+def render_heatmap(view, layer):
+    'Returns (buffer, mask) with the heatmap rendered to match the view.'
+    (width, height) = (view.width, view.height)
+    projector = make_array_projector(view, width, height)
+
+    counts = numpy.zeros(width * height)
+    for chunk in iter_point_chunks(layer.get_points()):
+        (xs, ys) = projector(chunk[:, 1], chunk[:, 0])
+        xs = numpy.floor(xs).astype(numpy.int64)
+        ys = numpy.floor(ys).astype(numpy.int64)
+        inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+        counts += numpy.bincount(ys[inside] * width + xs[inside],
+                                 minlength = width * height)
+
+    values = counts.reshape((height, width))
+    if layer.get_smoothing():
+        values = gaussian_smooth(values, layer.get_smoothing())
+    if layer.get_log_scale():
+        values = numpy.log1p(values)
+
+    (buffer, mask) = colorize(values, layer.get_stops())
+    mask = (mask * layer.get_opacity()).astype(numpy.uint8)
+    return (buffer, mask)
+
+def iter_point_chunks(points):
+    'Yields the points as float arrays of (lat, lng) rows.'
+    if isinstance(points, str):
+        if points.endswith('.npy'):
+            points = numpy.load(points, mmap_mode = 'r')
+        else:
+            yield from read_csv_chunks(points)
+            return
 
-    for ix in range(len(coords) - 1):
-        (x, y) = coords[ix]
-        (target_x, target_y) = coords[ix + 1]
-        rem_length = dist((x, y), (target_x, target_y))
-        vx = (target_x - x) / rem_length
-        vy = (target_y - y) / rem_length
+    if hasattr(points, 'shape'):
+        for start in range(0, len(points), HEATMAP_CHUNK_SIZE):
+            chunk = points[start : start + HEATMAP_CHUNK_SIZE]
+            yield numpy.asarray(chunk, dtype = float).reshape((-1, 2))
+    else:
+        for chunk in points:
+            yield numpy.asarray(chunk, dtype = float).reshape((-1, 2))
+
+def read_csv_chunks(filename):
+    '''Reads lat, lng from the first two columns. A first line that does
+    not start with a number is taken to be a header, and skipped.'''
+    with open(filename) as inf:
+        first = inf.readline()
+        if first and not is_number(first.split(',')[0]):
+            first = ''
+        lines = [first] if first else []
+        while True:
+            lines += itertools.islice(inf, HEATMAP_CHUNK_SIZE - len(lines))
+            if not lines:
+                return
+            yield numpy.loadtxt(lines, delimiter = ',', usecols = (0, 1),
+                                ndmin = 2)
+            lines = []
+
+def is_number(value):
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+def gaussian_smooth(values, sigma):
+    'Separable Gaussian blur, done as a sum of shifted copies per axis.'
+    radius = int(math.ceil(sigma * 3))
+    offsets = numpy.arange(-radius, radius + 1)
+    kernel = numpy.exp(-(offsets ** 2) / (2 * sigma ** 2))
+    kernel = kernel / kernel.sum()
+
+    for axis in (0, 1):
+        padded = numpy.pad(values, [(radius, radius) if ix == axis else (0, 0)
+                                    for ix in (0, 1)])
+        size = values.shape[axis]
+        result = numpy.zeros(values.shape)
+        for (ix, weight) in enumerate(kernel):
+            result += weight * padded.take(numpy.arange(ix, ix + size),
+                                           axis = axis)
+        values = result
+    return values
+
+def colorize(values, stops):
+    '''Maps an array of values to colours through the stops, returning
+    (buffer, mask) like render_raster. Values below the first stop get
+    mask 0, and values above the last stop get the last colour.'''
+    stops = tuple((stop, tuple(color)) for (stop, color) in stops)
+    if values.dtype.kind in 'iu' and values.dtype.itemsize <= 2:
+        # small integer types, like elevations, go through a lookup table
+        table = compile_lookup_table(stops, values.dtype.str)
+        indexes = values.astype(numpy.int32) - numpy.iinfo(values.dtype).min
+        pixels = table[indexes].view(numpy.uint8).reshape(values.shape + (4, ))
+        return (pixels[..., : 3], pixels[..., 3])
+
+    (stop_values, channels) = compile_stops(stops)
+    buffer = numpy.empty(values.shape + (3, ), dtype = numpy.uint8)
+    for (channel, channel_values) in enumerate(channels):
+        buffer[..., channel] = numpy.interp(values, stop_values,
+                                            channel_values)
+    mask = numpy.where(values >= stop_values[0], 255, 0).astype(numpy.uint8)
+    return (buffer, mask)
+
+@functools.lru_cache(maxsize = 32)
+def compile_stops(stops):
+    'Returns the stop values and the values of each colour channel as arrays.'
+    stop_values = numpy.array([stop for (stop, _) in stops], dtype = float)
+    channels = [numpy.array([color[channel] for (_, color) in stops],
+                            dtype = float)
+                for channel in range(3)]
+    return (stop_values, channels)
+
+@functools.lru_cache(maxsize = 32)
+def compile_lookup_table(stops, dtype):
+    '''Returns the colour and mask for every value of the integer dtype, in
+    order from the smallest value. Each entry is the RGB and mask bytes
+    packed into a uint32, so that colorizing is a single gather.'''
+    info = numpy.iinfo(numpy.dtype(dtype))
+    values = numpy.arange(info.min, info.max + 1, dtype = float)
+    (colors, mask) = colorize(values, stops)
+    table = numpy.concatenate((colors, mask[:, None]), axis = 1)
+    return table.view(numpy.uint32)[:, 0]
 
-        while rem_length > 0:
-            step = dasher.make_next_step(rem_length)
-            nx = x + vx * step
-            ny = y + vy * step
+# ===========================================================================
+# MARKER CLUSTERING
+
+class ClusterIndex:
+    '''A hierarchy of marker clusters, in the style of supercluster. For each
+    zoom level the clusters of the level below are grouped on a grid in Web
+    Mercator pixel space, so the hierarchy is built once and then queried
+    for any number of views. Clusters are drawn in the style of the first
+    marker in them.
+
+    radius: size of the grid cells, in pixels
+    min_points: smallest number of markers that makes a cluster'''
+
+    def __init__(self, markers, radius = 40, min_points = 2, max_zoom = 16):
+        self._markers = list(markers)
+        self._radius = radius
+        self._max_zoom = max_zoom
+
+        lngs = numpy.array([m.get_longitude() for m in self._markers],
+                           dtype = float)
+        lats = numpy.array([m.get_latitude() for m in self._markers],
+                           dtype = float)
+        (xs, ys) = lnglat_to_world(lngs, lats)
+
+        # a level is (xs, ys, counts, leaves), where xs and ys are in world
+        # coordinates from 0 to 1, and leaves are the indexes of the first
+        # marker in each cluster
+        level = (xs, ys, numpy.ones(len(xs)), numpy.arange(len(xs)))
+        self._levels = {max_zoom + 1 : level}
+        for zoom in range(max_zoom, -1, -1):
+            level = cluster_level(level, 256 * 2 ** zoom / radius, min_points)
+            self._levels[zoom] = level
+
+    def get_clusters(self, view, width, height):
+        '''Returns the clusters inside the view as a list of (point, count,
+        marker), where marker is one of the markers in the cluster.'''
+        (_, _, x_factor, _) = get_projection(view, width, height)
+        world_size = abs(x_factor) * 2 * math.pi * RADIUS # in pixels
+        zoom = int(math.floor(math.log2(world_size / 256)))
+        zoom = min(max(zoom, 0), self._max_zoom + 1)
+
+        (xs, ys, counts, leaves) = self._levels[zoom]
+        (lngs, lats) = world_to_lnglat(xs, ys)
+        (xs, ys) = make_array_projector(view, width, height)(lngs, lats)
+
+        margin = self._radius
+        inside = ((xs > -margin) & (xs < width + margin) &
+                  (ys > -margin) & (ys < height + margin))
+        return [((x, y), int(count), self._markers[leaf])
+                for (x, y, count, leaf) in zip(xs[inside].tolist(),
+                                               ys[inside].tolist(),
+                                               counts[inside].tolist(),
+                                               leaves[inside].tolist())]
+
+def cluster_level(level, cells, min_points):
+    '''Groups the clusters of a level on a grid with the given number of
+    cells across the world, producing the level above.'''
+    (xs, ys, counts, leaves) = level
+    cells = int(math.ceil(cells))
+    keys = (numpy.floor(xs * cells).astype(numpy.int64) * cells +
+            numpy.floor(ys * cells).astype(numpy.int64))
+    (groups, inverse) = numpy.unique(keys, return_inverse = True)
+    totals = numpy.bincount(inverse, weights = counts)
+
+    # cells with too few markers are left as they are
+    merge = totals[inverse] >= min_points
+    group = inverse[merge]
+    weights = counts[merge]
+    size = len(groups)
+    total = numpy.bincount(group, weights = weights, minlength = size)
+    used = total > 0
+    total = total[used]
+    group_xs = numpy.bincount(group, weights = xs[merge] * weights,
+                              minlength = size)[used] / total
+    group_ys = numpy.bincount(group, weights = ys[merge] * weights,
+                              minlength = size)[used] / total
+    group_leaves = numpy.full(size, len(leaves))
+    numpy.minimum.at(group_leaves, group, leaves[merge])
+
+    keep = ~merge
+    return (numpy.concatenate((group_xs, xs[keep])),
+            numpy.concatenate((group_ys, ys[keep])),
+            numpy.concatenate((total, counts[keep])),
+            numpy.concatenate((group_leaves[used], leaves[keep])))
+
+def lnglat_to_world(lngs, lats):
+    'Web Mercator, scaled so that the world goes from 0 to 1 in both axes.'
+    sin = numpy.clip(numpy.sin(numpy.radians(lats)), -0.9999, 0.9999)
+    ys = 0.5 - numpy.log((1 + sin) / (1 - sin)) / (4 * math.pi)
+    return (lngs / 360 + 0.5, numpy.clip(ys, 0, 1))
+
+def world_to_lnglat(xs, ys):
+    lats = numpy.degrees(numpy.arctan(numpy.sinh(math.pi * (1 - 2 * ys))))
+    return ((xs - 0.5) * 360, lats)
+
+CLUSTER_SIZE_STEPS = 4 # cluster sizes per tenfold increase in count
+
+def cluster_radius(radius, count):
+    '''The radius of the symbol for a cluster of count markers. Grows with
+    the log of the count, in steps, so that there are only a few sizes of
+    cluster symbols.'''
+    if count < 2:
+        return radius
+    steps = round(math.log10(count) * CLUSTER_SIZE_STEPS)
+    return round(radius * (1 + max(1, steps) / CLUSTER_SIZE_STEPS))
+
+def make_cluster_text_style(marker, radius):
+    'The style for the count shown on a cluster symbol.'
+    style = marker.get_text_style()
+    return mapbase.TextStyle(font_name = style.get_font_name(),
+                             font_size = max(8, int(radius)),
+                             font_color = style.get_font_color(),
+                             halo_color = style.get_halo_color(),
+                             halo_radius = 1,
+                             text_align = mapbase.TextAlignment.CENTERED)
 
-            if dasher.is_current_dash():
-                draw.line((x, y, nx, ny), fill = lc, width = lw)
+# ===========================================================================
+# DASHED LINE IMPLEMENTATION
 
-            x = nx
-            y = ny
-            rem_length -= step
+def make_dashes(coords, dash_pattern):
+    '''Splits a linestring into the dashes of the pattern, working on the
+    whole linestring at once. Returns a numpy array of all the dash points,
+    and an array of the indexes in it where each dash starts.'''
+    points = numpy.asarray(coords, dtype = float)
+    seglengths = numpy.hypot(*numpy.diff(points, axis = 0).T)
+    points = points[numpy.concatenate(([True], seglengths > 0))]
+    arclength = numpy.concatenate(([0], numpy.cumsum(seglengths[seglengths > 0])))
+    total = arclength[-1]
+    if total == 0:
+        return (numpy.zeros((0, 2)), numpy.zeros(0, dtype = int))
+
+    # the dashes are the even steps of the pattern. an odd-length pattern
+    # swaps dashes and gaps each time around, so it repeats after two turns
+    pattern = numpy.asarray(dash_pattern, dtype = float)
+    if len(pattern) % 2:
+        pattern = numpy.concatenate((pattern, pattern))
+    period = pattern.sum()
+    offsets = numpy.concatenate(([0], numpy.cumsum(pattern)[:-1]))[0 : : 2]
+    turns = numpy.arange(int(math.ceil(total / period)))
+    starts = (turns[:, None] * period + offsets[None, :]).ravel()
+    ends = numpy.minimum(starts + numpy.tile(pattern[0 : : 2], len(turns)),
+                         total)
+    keep = starts < total
+    (starts, ends) = (starts[keep], ends[keep])
+
+    # each dash is its start and end point, plus the vertexes in between
+    first_inner = numpy.searchsorted(arclength, starts, side = 'right')
+    last_inner = numpy.searchsorted(arclength, ends, side = 'left')
+    inner_counts = numpy.maximum(last_inner - first_inner, 0)
+    counts = inner_counts + 2
+    dash_starts = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+
+    positions = numpy.repeat(dash_starts, counts)
+    step = numpy.arange(counts.sum()) - positions # index within dash
+    dash_ix = numpy.repeat(numpy.arange(len(counts)), counts)
+
+    # arc length of every output point: start, inner vertexes, end
+    vertex = numpy.minimum(first_inner[dash_ix] + step - 1, len(arclength) - 1)
+    along = arclength[vertex]
+    along[step == 0] = starts
+    along[step == counts[dash_ix] - 1] = ends
+
+    dashpoints = numpy.empty((len(along), 2))
+    dashpoints[:, 0] = numpy.interp(along, arclength, points[:, 0])
+    dashpoints[:, 1] = numpy.interp(along, arclength, points[:, 1])
+    return (dashpoints, dash_starts)
+
+def draw_dashed_line(draw, coords, lc, lw, dashing):
+    # ImageDraw has no call for many disjoint lines, so it's still one call
+    # per dash, but everything else is done once for the whole linestring
+    (dashpoints, dash_starts) = make_dashes(coords, dashing)
+    points = dashpoints.tolist()
+    ends = dash_starts[1 : ].tolist() + [len(points)]
+    line = draw.line
+    for (start, end) in zip(dash_starts.tolist(), ends):
+        line(points[start : end], fill = lc, width = lw)
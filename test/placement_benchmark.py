@@ -0,0 +1,32 @@
+'''
+Times label placement in OverlapIndex for growing numbers of markers. The
+time per marker should stay roughly constant as the count grows.
+
+Run with: python -m test.placement_benchmark
+'''
+
+import random, time
+from smappy import native
+
+def place(count, width = 4000, height = 3000):
+    rand = random.Random(count)
+    points = [(rand.uniform(0, width), rand.uniform(0, height))
+              for ix in range(count)]
+    radius = 5
+
+    start = time.time()
+    index = native.OverlapIndex()
+    for (x, y) in points:
+        index.add_bbox((x - radius, y - radius, x + radius, y + radius),
+                       'marker')
+    placed = 0
+    for (ix, pt) in enumerate(points):
+        if index.find_text_position(pt, 'M%s' % ix, (0, 0, 40, 12), radius):
+            placed += 1
+    return (time.time() - start, placed)
+
+if __name__ == '__main__':
+    for count in (1000, 2000, 5000, 10000, 20000, 40000):
+        (seconds, placed) = place(count)
+        print('%6d markers: %6.3f s, %8.1f us/marker, %6d labels placed' %
+              (count, seconds, seconds / count * 1_000_000, placed))
@@ -1,9 +1,9 @@
 
-import unittest, tempfile, os, urllib, logging, zipfile
+import unittest, tempfile, os, urllib, logging, zipfile, random
 from http.client import HTTPConnection
 from pathlib import Path
 from PIL import Image
-from smappy import mapbase, googlemap, prefab
+from smappy import mapbase, googlemap, prefab, native
 
 def enable_request_logging():
     HTTPConnection.debuglevel = 1
@@ -17,6 +17,11 @@ def enable_request_logging():
 #enable_request_logging()
 
 SHAPEDIR = os.environ.get('SHAPEDIR') # shapefiles must be located here
+FONT = os.environ.get('FONT') or next(( # a TrueType font for text tests
+    font for font in ['/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
+                      '/System/Library/Fonts/Supplemental/Arial.ttf']
+    if os.path.exists(font)
+), None)
 ROOT = Path(__file__).parent
 MIN_SIMILARITY = 5
 CACHE = ROOT / 'blob-cache'
@@ -82,6 +87,43 @@ class TestMaps(unittest.TestCase):
             base = cache.get_blob('simple-native.png')
             self.assertTrue(img_eq(base, tstfile + '.png'))
 
+    def test_banded_native_png(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tstfile = tmpdir + '/' + 'tst'
+
+            rivers = [
+               ('name', 'Rhine'),
+               ('name', 'Main'),
+            ]
+            view = prefab.MapView(west = 5, east = 28, north = 56, south = 46,
+                                  width = 2000, height = 1600)
+            themap = prefab.build_natural_earth(view, SHAPEDIR, rivers = rivers)
+            themap.render_to(tstfile, band_height = 300)
+
+            base = cache.get_blob('simple-native.png')
+            self.assertTrue(img_eq(base, tstfile + '.png'))
+
+    def test_draft_native_png(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tstfile = tmpdir + '/' + 'tst'
+
+            rivers = [
+               ('name', 'Rhine'),
+               ('name', 'Main'),
+            ]
+            view = prefab.MapView(west = 5, east = 28, north = 56, south = 46,
+                                  width = 2000, height = 1600)
+            themap = prefab.build_natural_earth(view, SHAPEDIR, rivers = rivers)
+            themap.render_to(tstfile, quality = 'draft')
+
+            # no antialiasing, so only roughly like the normal rendering
+            base = cache.get_blob('simple-native.png')
+            self.assertTrue(img_diff(base, tstfile + '.png') < 20)
+
+            # and the geometry really was simplified
+            self.assertTrue(count_vertices(themap, 'draft') <
+                            count_vertices(themap, 'normal') * 0.8)
+
     def test_elevation_native_png(self):
         with tempfile.TemporaryDirectory() as tmpdir:
             tstfile = tmpdir + '/' + 'tst'
@@ -111,6 +153,649 @@ class TestMaps(unittest.TestCase):
             base = cache.get_blob('simple-native.png')
             self.assertTrue(img_eq(base, tstfile + '.png'))
 
+class TestOverlapIndex(unittest.TestCase):
+
+    def test_same_as_linear_scan(self):
+        rand = random.Random(1)
+        index = native.OverlapIndex(cell_size = 50)
+        placed = []
+        for ix in range(2000):
+            (x, y) = (rand.uniform(-100, 2000), rand.uniform(-100, 1500))
+            bbox = (x, y, x + rand.uniform(0, 120), y + rand.uniform(0, 30))
+
+            expected = None
+            for (other, text) in placed:
+                if native.overlaps(other, bbox):
+                    expected = text
+                    break
+            self.assertEqual(expected, index.overlaps(bbox))
+
+            if not expected:
+                index.add_bbox(bbox, 'box%s' % ix)
+                placed.append((bbox, 'box%s' % ix))
+
+class TestClusterIndex(unittest.TestCase):
+
+    def test_counts_add_up(self):
+        rand = random.Random(1)
+        marker = mapbase.Marker('#ff0000')
+        markers = [mapbase.PositionedMarker(rand.uniform(45, 65),
+                                            rand.uniform(-5, 25),
+                                            'm%s' % ix, marker)
+                   for ix in range(5000)]
+        index = native.ClusterIndex(markers)
+
+        view = mapbase.MapView(east = 40, west = -20, south = 30, north = 75,
+                               width = 800, height = 800)
+        clusters = index.get_clusters(view, view.width, view.height)
+        self.assertEqual(5000, sum(count for (_, count, _) in clusters))
+        self.assertTrue(len(clusters) < 1000)
+
+    @unittest.skipUnless(FONT, 'needs a TrueType font, set FONT')
+    def test_cluster_sprites_reused(self):
+        rand = random.Random(2)
+        style = mapbase.TextStyle(font_name = FONT, font_size = 10)
+        marker = mapbase.Marker('#ff0000', text_style = style)
+        view = mapbase.MapView(east = 40, west = -20, south = 30, north = 75,
+                               width = 800, height = 800)
+        themap = native.NativeMap(view)
+        for ix in range(5000):
+            themap.add_marker(rand.gauss(55, 5), rand.gauss(10, 8),
+                              'm%s' % ix, marker)
+        themap.set_clustering()
+
+        native.make_sprite.cache_clear()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            themap.render_to(os.path.join(tmpdir, 'clusters'))
+
+        # one sprite per cluster size, not one per cluster
+        info = native.make_sprite.cache_info()
+        self.assertTrue(info.misses <= 15, info)
+
+class TestBands(unittest.TestCase):
+
+    def make_map(self):
+        view = mapbase.MapView(east = 20, west = 0, south = 50, north = 60,
+                               width = 200, height = 150)
+        themap = native.NativeMap(view)
+        for ix in range(10):
+            themap.add_marker(51 + ix * 0.8, 1 + ix * 2, 'marker',
+                              mapbase.Marker('#ff0000'))
+        return themap
+
+    def test_same_as_unbanded(self):
+        themap = self.make_map()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            themap.render_to(tmpdir + '/whole')
+            themap.render_to(tmpdir + '/banded', band_height = 40)
+            self.assertTrue(img_eq(tmpdir + '/whole.png',
+                                   tmpdir + '/banded.png'))
+            self.assertEqual(['banded.png', 'whole.png'],
+                             sorted(os.listdir(tmpdir)))
+
+    def test_failed_band_leaves_no_file(self):
+        from unittest import mock
+        themap = self.make_map()
+        draw = themap._draw
+        def fail_in_third_band(drawer, layers, placed, band = None):
+            if band[0] == 2:
+                raise OSError('cannot read raster')
+            draw(drawer, layers, placed, band)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with mock.patch.object(themap, '_draw', fail_in_third_band):
+                with self.assertRaises(OSError):
+                    themap.render_to(tmpdir + '/tst', band_height = 40)
+            self.assertEqual([], os.listdir(tmpdir))
+
+class TestPointShapefile(unittest.TestCase):
+
+    def test_read_points(self):
+        import shapefile
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'points')
+            writer = shapefile.Writer(filename, shapeType = shapefile.POINT)
+            writer.field('name', 'C')
+            for ix in range(10):
+                writer.point(ix * 1.5, 60 - ix)
+                writer.record('point%s' % ix)
+            writer.close()
+
+            points = native.read_point_shapefile(filename + '.shp')
+            self.assertEqual([[ix * 1.5, 60 - ix] for ix in range(10)],
+                             points.tolist())
+
+class TestSimplification(unittest.TestCase):
+
+    def test_draft_drops_vertices(self):
+        import shapefile
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # a line with a vertex every ~0.1 pixels, and one with 100 pixels
+            filename = os.path.join(tmpdir, 'lines')
+            writer = shapefile.Writer(filename, shapeType = shapefile.POLYLINE)
+            writer.field('name', 'C')
+            writer.line([[(0 + ix * 0.001, 55) for ix in range(1000)]])
+            writer.record('dense')
+            writer.line([[(ix, 52) for ix in range(10)]])
+            writer.record('sparse')
+            writer.close()
+
+            view = mapbase.MapView(east = 10, west = 0, south = 50, north = 57,
+                                   width = 1000, height = 700)
+            themap = native.NativeMap(view)
+            themap.add_shapes(filename + '.shp', line_color = '#000000')
+
+            self.assertEqual(1010, count_vertices(themap, 'normal'))
+            # one vertex per pixel for the dense line, the sparse one intact
+            self.assertTrue(count_vertices(themap, 'draft') < 120)
+            (dense, sparse) = prepare_shapes(themap, 'draft')
+            self.assertEqual(10, len(sparse[0][0]))
+
+class TestRasterWindow(unittest.TestCase):
+
+    def test_decimated_window(self):
+        import numpy, rasterio
+
+        data = numpy.arange(360 * 180, dtype = numpy.int16).reshape((180, 360))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            raster = os.path.join(tmpdir, 'raster.tif')
+            write_test_raster(raster, data)
+            with rasterio.open(raster) as dataset:
+                (band, transform) = native.read_window(dataset, 0, 60, 40, 40,
+                                                       20, 10)
+
+        self.assertEqual((11, 21), band.shape)
+        self.assertEqual((0, 60), (transform.c, transform.f))
+        self.assertEqual((2, -2), (transform.a, transform.e))
+        self.assertIn(band[0, 0], data[30 : 32, 180 : 182]) # one of 2x2 cells
+
+class TestBandCache(unittest.TestCase):
+
+    def test_mapped_band(self):
+        import numpy
+
+        data = numpy.arange(360 * 180, dtype = numpy.int16).reshape((180, 360))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            raster = os.path.join(tmpdir, 'raster.tif')
+            write_test_raster(raster, data)
+
+            bands = os.path.join(tmpdir, 'bands')
+            for (width, height) in [(20, 10), (100, 100)]:
+                (band, transform) = native.read_raster(raster, bands, 0, 60,
+                                                       40, 40, width, height)
+                (band2, transform2) = native.read_raster(raster, None, 0, 60,
+                                                         40, 40, width, height)
+                self.assertEqual(transform2, transform)
+                self.assertEqual(band2.shape, band.shape)
+            self.assertTrue((band2 == band).all()) # not decimated
+            self.assertEqual(1, len(os.listdir(bands)))
+
+    def test_concurrent_band_mapping(self):
+        import numpy, rasterio
+        from concurrent.futures import ThreadPoolExecutor
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            raster = os.path.join(tmpdir, 'raster.tif')
+            data = numpy.arange(180 * 360, dtype = numpy.int32).reshape((180, 360))
+            write_test_raster(raster, data)
+
+            cachedir = os.path.join(tmpdir, 'bands')
+            def map_band(ix):
+                with rasterio.open(raster) as dataset:
+                    return native.map_band(dataset, cachedir)
+            with ThreadPoolExecutor(4) as pool:
+                bands = list(pool.map(map_band, range(8)))
+
+            for band in bands:
+                self.assertTrue((band == data).all())
+            self.assertEqual(1, len(os.listdir(cachedir)))
+
+class TestInterpolate(unittest.TestCase):
+
+    def test_row_gaps(self):
+        import numpy
+        buffer = numpy.zeros((3, 4, 3), dtype = numpy.uint8)
+        buffer[0, 3] = (90, 30, 60)
+        mask = numpy.array([[255, 0, 0, 255],  # between two values
+                            [1, 0, 0, 1],      # between two no data
+                            [255, 0, 0, 1]],   # mixed
+                           dtype = numpy.uint8)
+        native.fill_gaps(buffer, mask, True)
+
+        self.assertEqual([[30, 10, 20], [60, 20, 40]], buffer[0, 1 : 3].tolist())
+        self.assertEqual([255, 255, 255, 255], mask[0].tolist())
+        self.assertEqual([1, 1, 1, 1], mask[1].tolist())
+        self.assertEqual([255, 0, 0, 1], mask[2].tolist())
+        self.assertEqual(0, buffer[1 : ].sum())
+
+    def test_no_data_only_filled_along_rows(self):
+        import numpy
+        buffer = numpy.zeros((3, 2, 3), dtype = numpy.uint8)
+        buffer[2, 0] = (90, 30, 60)
+        mask = numpy.array([[255, 1],
+                            [0, 0],
+                            [255, 1]], dtype = numpy.uint8)
+        native.interpolate(buffer, mask)
+
+        self.assertEqual([45, 15, 30], buffer[1, 0].tolist())
+        self.assertEqual([[255, 1], [255, 0], [255, 1]], mask.tolist())
+
+class TestColorize(unittest.TestCase):
+
+    STOPS = [(0, (0, 0, 0)), (100, (200, 100, 50)), (1000, (255, 255, 255))]
+
+    def test_lookup_table_matches_float_path(self):
+        import numpy
+        values = numpy.arange(-300, 1300, dtype = numpy.int16)
+        (buffer, mask) = native.colorize(values, self.STOPS)
+        (fbuffer, fmask) = native.colorize(values.astype(float), self.STOPS)
+        self.assertTrue((buffer == fbuffer).all())
+        self.assertTrue((mask == fmask).all())
+
+        below = values < 0
+        self.assertFalse(mask[below].any())
+        self.assertTrue((mask[~below] == 255).all())
+        self.assertEqual([100, 50, 25], buffer[values == 50][0].tolist())
+        self.assertTrue((buffer[values >= 1000] == 255).all()) # clamped
+
+        # and within rounding of interpolating stop by stop, the old way
+        for (value, color) in zip(values.tolist(), buffer.tolist()):
+            if value < 0:
+                continue
+            for ((stop0, color0), (stop1, color1)) in zip(self.STOPS,
+                                                          self.STOPS[1 : ]):
+                if value <= stop1:
+                    dist = (value - stop0) / (stop1 - stop0)
+                    expected = [c0 + (c1 - c0) * dist
+                                for (c0, c1) in zip(color0, color1)]
+                    break
+            else:
+                expected = self.STOPS[-1][1]
+            for (v1, v2) in zip(color, expected):
+                self.assertAlmostEqual(v1, v2, delta = 1)
+
+class TestTileCache(unittest.TestCase):
+
+    def test_tiles_are_reused(self):
+        import numpy
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            raster = os.path.join(tmpdir, 'raster.tif')
+            write_test_raster(raster, numpy.full((180, 360), 100,
+                                                 dtype = numpy.int16))
+
+            stops = [(0, (0, 0, 0)), (200, (200, 100, 50))]
+            view = mapbase.MapView(east = 30, west = 0, south = 50, north = 70,
+                                   width = 100, height = 80)
+            tiles = os.path.join(tmpdir, 'tiles')
+            cache = native.TileCache(tiles)
+            (buffer, mask) = cache.render(view, raster, stops)
+            self.assertEqual((80, 100, 3), buffer.shape)
+            self.assertEqual([100, 50, 25], list(buffer[40, 50]))
+            self.assertEqual(255, mask[40, 50])
+
+            key = native.tile_set_key(raster, stops)
+            self.assertTrue(os.listdir(os.path.join(tiles, key)))
+            (buffer2, _) = cache.render(view, raster, stops)
+            self.assertTrue((buffer == buffer2).all())
+
+            os.utime(raster, (0, 0)) # a changed raster gets new tiles
+            self.assertNotEqual(key, native.tile_set_key(raster, stops))
+
+    def test_concurrent_tile_writes(self):
+        import numpy
+        from concurrent.futures import ThreadPoolExecutor
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            raster = os.path.join(tmpdir, 'raster.tif')
+            write_test_raster(raster, numpy.full((18, 36), 100,
+                                                 dtype = numpy.int16))
+
+            # the same tile rendered by several threads at once
+            stops = [(0, (0, 0, 0)), (200, (200, 100, 50))]
+            tiles = os.path.join(tmpdir, 'tiles')
+            with ThreadPoolExecutor(4) as pool:
+                list(pool.map(lambda ix: native.get_tile(tiles, raster, stops,
+                                                         2, 2, 1),
+                              range(8)))
+
+            self.assertEqual(['2_1.png'], os.listdir(tiles))
+
+class TestPdfPath(unittest.TestCase):
+
+    def test_rounded_and_deduplicated(self):
+        coords = [(0, 0), (0.01, 0.02), (10.04, 5), (10.01, 5.03), (3, 3)]
+        self.assertEqual([[0, 0], [10, 5], [3, 3]], native.to_pdf_path(coords))
+
+class TestAtlas(unittest.TestCase):
+
+    def test_one_page_per_view(self):
+        views = [mapbase.MapView(east = 10 + ix, west = ix, south = 50,
+                                 north = 60, width = 200, height = 150)
+                 for ix in range(3)]
+        themap = native.NativeMap(views[0])
+        themap.add_marker(55, 5, 'marker', mapbase.Marker('#ff0000'))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tstfile = tmpdir + '/' + 'tst'
+            themap.render_atlas(tstfile, views)
+
+            with open(tstfile + '.pdf', 'rb') as f:
+                self.assertIn(b'/Count 3', f.read())
+
+    def test_geometry_parsed_once(self):
+        import shapefile
+        from unittest import mock
+        views = [mapbase.MapView(east = 10 + ix, west = ix, south = 50,
+                                 north = 60, width = 200, height = 150)
+                 for ix in range(3)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'lines')
+            writer = shapefile.Writer(filename, shapeType = shapefile.POLYLINE)
+            writer.field('name', 'C')
+            writer.line([[(ix, 50 + ix) for ix in range(12)]])
+            writer.record('line')
+            writer.close()
+
+            themap = native.NativeMap(views[0])
+            themap.add_shapes(filename + '.shp', line_color = '#000000',
+                              line_width = 1)
+            with mock.patch.object(native, 'extract_features_shp',
+                                   wraps = native.extract_features_shp) as parse:
+                themap.render_atlas(tmpdir + '/' + 'tst', views)
+            self.assertEqual(1, parse.call_count)
+
+    def test_no_views(self):
+        themap = native.NativeMap(mapbase.MapView(east = 10, west = 0,
+                                                  south = 50, north = 60,
+                                                  width = 200, height = 150))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tstfile = tmpdir + '/' + 'tst'
+            with self.assertRaises(ValueError):
+                themap.render_atlas(tstfile, [])
+            self.assertFalse(os.path.exists(tstfile + '.pdf'))
+
+    def test_raster_embedded_once(self):
+        import numpy
+        drawer = native.PdfDrawer(20, 10, mapbase.to_color('#ffffff'))
+        image = numpy.zeros((10, 20, 3), dtype = numpy.uint8)
+        mask = numpy.full((10, 20), 255, dtype = numpy.uint8)
+        mask[ : 5] = 0
+        for ix in range(3):
+            if ix:
+                drawer.add_page(20, 10, mapbase.to_color('#ffffff'))
+            drawer.bitmap(image, (0, 0), mask)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            drawer.write_to(tmpdir + '/tst.pdf')
+            with open(tmpdir + '/tst.pdf', 'rb') as f:
+                pdf = f.read()
+        self.assertEqual(1, pdf.count(b'/SMask'))
+
+class TestSvgDrawer(unittest.TestCase):
+
+    def test_relative_rounded_path(self):
+        import io
+        outf = io.StringIO()
+        drawer = native.SvgDrawer(outf, 100, 100, mapbase.to_color('#ffffff'))
+        drawer.line([(1.04, 2), (3, 2.01), (3, 2), (1, 5)],
+                    mapbase.to_line_format('#000000', 1))
+        drawer.close()
+        self.assertIn('<path d="M10 20l20 0 -20 30"/>', outf.getvalue())
+
+    def test_markers_defined_once(self):
+        import xml.dom.minidom
+        view = mapbase.MapView(east = 20, west = 0, south = 50, north = 60,
+                               width = 200, height = 150)
+        themap = native.NativeMap(view)
+        marker = mapbase.Marker('#ff0000')
+        for ix in range(10):
+            themap.add_marker(51 + ix * 0.5, 1 + ix, 'marker', marker)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tstfile = tmpdir + '/' + 'tst'
+            themap.render_to(tstfile, 'svg')
+
+            doc = xml.dom.minidom.parse(tstfile + '.svg')
+            self.assertEqual(1, len(doc.getElementsByTagName('defs')))
+            self.assertEqual(10, len(doc.getElementsByTagName('use')))
+
+class TestPolygonFill(unittest.TestCase):
+
+    OUTER = [(10, 10), (90, 10), (90, 90), (10, 90)]
+    HOLE = [(40, 40), (60, 40), (60, 60), (40, 60)]
+
+    def test_png_hole_and_opacity(self):
+        drawer = native.PngDrawer(100, 100, mapbase.to_color('#ffffff'))
+        drawer.polygons([[self.OUTER, self.HOLE]], None,
+                        mapbase.to_color('#000000'), 0.5)
+        image = drawer.get_image()
+        self.assertEqual((255, 255, 255), image.getpixel((50, 50))[ : 3])
+        self.assertEqual((255, 255, 255), image.getpixel((5, 5))[ : 3])
+        for value in image.getpixel((25, 25))[ : 3]:
+            self.assertAlmostEqual(128, value, delta = 2)
+
+    def test_pdf_hole_is_even_odd(self):
+        drawer = native.PdfDrawer(100, 100, mapbase.to_color('#ffffff'))
+        drawer.polygons([[self.OUTER, self.HOLE]], None,
+                        mapbase.to_color('#000000'), 0.5)
+        (pdf, content) = read_pdf(drawer)
+        self.assertIn(b'f*', content) # both rings in one even-odd fill
+        self.assertIn(b'/ca 0.5', pdf)
+
+class TestStrokedSymbols(unittest.TestCase):
+
+    POINTS = [(20 + ix * 4, 30 + ix % 3) for ix in range(10)] # overlapping
+
+    def test_outline_then_fill_per_symbol(self):
+        import re
+        pt = 72 / 25.4 # the page is in mm, the content stream in points
+        for shape in (mapbase.Shape.CIRCLE, mapbase.Shape.SQUARE):
+            drawer = native.PdfDrawer(100, 100, mapbase.to_color('#ffffff'))
+            marker = mapbase.Marker('#ff0000', shape = shape,
+                                    line_color = '#0000ff', line_width = 3)
+            drawer.symbols(self.POINTS, marker, 5)
+            (_, content) = read_pdf(drawer)
+
+            # one stroke for the outline, then one for the fill, per symbol
+            strokes = re.findall(rb'([\d.]+) w\s+([\d. ]+) RG\s+[\d. ]+ m '
+                                 rb'[\d. ]+ l S', content)
+            outline = (round((5 * 2 + 3 / 1.5) * pt, 2), (0, 0, 1))
+            fill = (round((5 * 2 - 3 / 1.5) * pt, 2), (1, 0, 0))
+            self.assertEqual([outline, fill] * len(self.POINTS),
+                             [(float(width),
+                               tuple(float(v) for v in color.split()))
+                              for (width, color) in strokes])
+
+    def test_few_symbols_drawn_as_shapes(self):
+        drawer = native.PdfDrawer(100, 100, mapbase.to_color('#ffffff'))
+        points = self.POINTS[ : native.PDF_MIN_STROKED_SYMBOLS - 1]
+        drawer.symbols(points, mapbase.Marker('#ff0000'), 5)
+        (_, content) = read_pdf(drawer)
+        self.assertNotIn(b' l S', content)
+        self.assertEqual(len(points) + 1, content.count(b' B')) # + background
+
+class TestDashes(unittest.TestCase):
+
+    def dashes(self, coords, pattern):
+        import numpy
+        (points, starts) = native.make_dashes(coords, pattern)
+        return [dash.tolist() for dash in numpy.split(points, starts[1 : ])
+                if len(dash)]
+
+    def test_dash_carried_across_vertex(self):
+        self.assertEqual([[[0, 0], [4, 0]],
+                          [[7, 0], [10, 0], [10, 1]],
+                          [[10, 4], [10, 8]]],
+                         self.dashes([(0, 0), (10, 0), (10, 10)], (4, 3)))
+
+    def test_odd_length_pattern(self):
+        # (2, 1, 3) repeats as 2 on, 1 off, 3 on, 2 off, 1 on, 3 off
+        self.assertEqual([[[0, 0], [2, 0]], [[3, 0], [6, 0]], [[8, 0], [9, 0]]],
+                         self.dashes([(0, 0), (12, 0)], (2, 1, 3)))
+
+    def test_zero_length_segments(self):
+        self.assertEqual([[[0, 0], [4, 0]], [[6, 0], [10, 0]]],
+                         self.dashes([(0, 0), (5, 0), (5, 0), (10, 0)], (4, 2)))
+        self.assertEqual([], self.dashes([(3, 3), (3, 3)], (4, 2)))
+
+class TestSprites(unittest.TestCase):
+
+    def test_sprite_reused(self):
+        native.make_sprite.cache_clear()
+        marker = mapbase.Marker('#ff0000', shape = mapbase.Shape.SQUARE)
+        drawer = native.PngDrawer(100, 100, mapbase.to_color('#ffffff'))
+        drawer.symbols([(20, 20), (50, 50)], marker, 5)
+        drawer.symbols([(80, 80)], marker, 5)
+
+        info = native.make_sprite.cache_info()
+        self.assertEqual((1, 1), (info.misses, info.hits))
+        image = drawer.get_image()
+        for pt in [(20, 20), (50, 50), (80, 80)]:
+            self.assertEqual((255, 0, 0), image.getpixel(pt)[ : 3])
+
+@unittest.skipUnless(FONT, 'needs a TrueType font, set FONT')
+class TestFonts(unittest.TestCase):
+
+    def test_font_loaded_once(self):
+        native.load_font.cache_clear()
+        native.measure_text.cache_clear()
+        style = mapbase.TextStyle(font_name = FONT, font_size = 12)
+        drawer = native.PngDrawer(100, 100, mapbase.to_color('#ffffff'))
+        for ix in range(3):
+            drawer.get_bbox('font test %s' % ix, style)
+
+        info = native.load_font.cache_info()
+        self.assertEqual((1, 2), (info.misses, info.hits))
+
+@unittest.skipUnless(FONT, 'needs a TrueType font, set FONT')
+class TestLabels(unittest.TestCase):
+
+    STYLE = mapbase.TextStyle(font_name = FONT, font_size = 20,
+                              font_color = '#000000', halo_color = '#ff0000',
+                              halo_radius = 3)
+
+    def test_cache_hits(self):
+        cache = native.LabelCache(1_000_000)
+        label = cache.get_label('Oslo', self.STYLE, 1)
+        self.assertIs(label, cache.get_label('Oslo', self.STYLE, 1))
+        self.assertEqual((1, 1), (cache.misses, cache.hits))
+        self.assertEqual(label.extent, cache.get_extent('Oslo', self.STYLE, 1))
+
+    def test_halo_pixels(self):
+        label = native.render_label('Oslo', self.STYLE, 1)
+        colors = {color for (count, color) in label.image.getcolors(100_000)
+                  if color[3] == 255}
+        self.assertIn((255, 0, 0, 255), colors)
+        self.assertIn((0, 0, 0, 255), colors)
+
+        plain = native.measure_label('Oslo', native.without_halo(self.STYLE), 1)
+        (left, top, right, bottom) = label.extent
+        self.assertEqual(right - left, plain[2] - plain[0] + 6)
+
+    def test_measurements_cached(self):
+        import io
+        white = mapbase.to_color('#ffffff')
+        drawers = [native.PdfDrawer(100, 100, white),
+                   native.SvgDrawer(io.StringIO(), 100, 100, white)]
+        bigger = mapbase.TextStyle(font_name = FONT, font_size = 30,
+                                   halo_color = '#ff0000', halo_radius = 3)
+        native.measure_text.cache_clear()
+        for ix in range(3):
+            for drawer in drawers:
+                bbox = drawer.get_bbox('Oslo', self.STYLE)
+                big = drawer.get_bbox('Oslo', bigger)
+
+        # once per style, shared by the drawers
+        info = native.measure_text.cache_info()
+        self.assertEqual((2, 10), (info.misses, info.hits))
+
+        # the same as measuring afresh, and not mixed up between sizes
+        measure = native.measure_text.__wrapped__
+        self.assertEqual(measure('Oslo', FONT, 20, 3), bbox)
+        self.assertEqual(measure('Oslo', FONT, 30, 3), big)
+        self.assertNotEqual(bbox, big)
+
+    def test_same_bbox_in_all_drawers(self):
+        import io
+        white = mapbase.to_color('#ffffff')
+        pdf = native.PdfDrawer(100, 100, white).get_bbox('Oslo', self.STYLE)
+        svg = native.SvgDrawer(io.StringIO(), 100, 100, white).get_bbox(
+            'Oslo', self.STYLE
+        )
+        png = native.PngDrawer(100, 100, white).get_bbox('Oslo', self.STYLE)
+        self.assertEqual(pdf, svg)
+        for (v1, v2) in zip(pdf, png):
+            self.assertAlmostEqual(v1, v2, delta = 1.5) # png measures at 4x
+
+class TestHeatmap(unittest.TestCase):
+
+    def test_points_are_binned(self):
+        view = mapbase.MapView(east = 20, west = 0, south = 50, north = 60,
+                               width = 200, height = 150)
+        points = [[55, 10]] * 5 + [[58, 2]] + [[80, 10]] # last is outside
+        layer = mapbase.HeatmapLayer([points[ : 3], points[3 : ]],
+                                     [(1, (0, 0, 0)), (5, (255, 255, 255))])
+        (buffer, mask) = native.render_heatmap(view, layer)
+
+        (x, y) = native.make_projector(view, 200, 150)((10, 55))
+        self.assertEqual(255, buffer[int(y), int(x), 0])
+        self.assertEqual(2, (mask == 255).sum())
+
+    def test_csv_with_header(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'points.csv')
+            with open(filename, 'w') as outf:
+                outf.write('lat,lng,name\n55.5,10.5,a\n58,2,b\n')
+            chunks = list(native.read_csv_chunks(filename))
+
+            with open(filename, 'w') as outf:
+                outf.write('55.5,10.5,a\n58,2,b\n')
+            headerless = list(native.read_csv_chunks(filename))
+
+        self.assertEqual([[55.5, 10.5], [58, 2]], chunks[0].tolist())
+        self.assertEqual(chunks[0].tolist(), headerless[0].tolist())
+
+def write_test_raster(path, data, transform = None):
+    '''Writes the 2D array as a single band GeoTIFF. By default the raster
+    covers the whole world.'''
+    import rasterio
+    from rasterio.transform import from_origin
+
+    (height, width) = data.shape
+    transform = transform or from_origin(-180, 90, 360 / width, 180 / height)
+    with rasterio.open(path, 'w', driver = 'GTiff', width = width,
+                       height = height, count = 1, dtype = data.dtype,
+                       transform = transform) as dataset:
+        dataset.write(data, 1)
+
+def prepare_shapes(themap, quality):
+    view = themap._view
+    projector = native.make_projector(view, view.width, view.height)
+    return [shape
+            for layer in themap._layers
+            for shape in themap._prepare_layer(
+                    layer, projector, native.get_quality(quality)).get_shapes()]
+
+def count_vertices(themap, quality):
+    return sum(len(ring)
+               for (rings, closed) in prepare_shapes(themap, quality)
+               for ring in rings)
+
+def read_pdf(drawer):
+    'Returns the PDF the drawer writes, and its decompressed content.'
+    import re, zlib
+    with tempfile.TemporaryDirectory() as tmpdir:
+        drawer.write_to(tmpdir + '/tst.pdf')
+        with open(tmpdir + '/tst.pdf', 'rb') as f:
+            pdf = f.read()
+
+    content = b''
+    for stream in re.findall(rb'stream\r?\n(.*?)endstream', pdf, re.S):
+        try:
+            content += zlib.decompress(stream)
+        except zlib.error:
+            pass
+    return (pdf, content)
+
 def img_eq(f1, f2):
     return img_diff(f1, f2) < MIN_SIMILARITY
 